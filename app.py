@@ -1,30 +1,61 @@
-"""Data visualization using Dash and plotly express: https://dash.plotly.com"""
+"""Data visualization using Dash and plotly express: https://dash.plotly.com
+
+The app is built by create_app. run_app serves it with the Flask development server,
+wsgi.py builds it for pre-fork WSGI servers.
+"""
 import time
 import datetime
-from typing import Any
-import plotly.express as px
+from typing import Optional
+import pandas as pd
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output
 import dash_bootstrap_components as dbc
 import dash_daq as daq
+from util import data_api
 from util import data_loading
 from util import graph_updater
+from util import metrics
+from util import regions
 
 # Using dbc for specific components: https://dash-bootstrap-components.opensource.faculty.ai
 
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP,
-                                                data_loading.read_style_sheet()],)
-app.title = "Pandemic's Impact on the Public Sentiment"
+# slice, downsample and toggle the traces in the browser (assets/graphs.js) instead of
+# rebuilding the figures on the server for every interaction
+CLIENTSIDE_GRAPHS = True
 
+# seconds browsers may cache the files in assets, their urls change when they are modified
+STATIC_MAX_AGE = 60 * 60 * 24 * 7
 
-# Data loading
-data_sets = data_loading.get_data()
+
+def create_app(data_sets: Optional[dict[str, pd.DataFrame]] = None) -> dash.Dash:
+    """
+    Builds the app around data_sets, loaded with data_loading.get_data when not given.
+    Responses are compressed and the files in assets are sent with cache headers.
+    The data sets are also served as json or npz by date range, see data_api.
+    Nothing is loaded per request, so in a pre-fork server the app can be built once in
+    the master and shared by the workers (see wsgi.py).
+    Prints how long building the app took.
+    """
+    start = time.perf_counter()
+    if data_sets is None:
+        data_sets = data_loading.get_data()
+    app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP,
+                                                    data_loading.read_style_sheet()],
+                    compress=True)
+    app.title = "Pandemic's Impact on the Public Sentiment"
+    app.server.config['SEND_FILE_MAX_AGE_DEFAULT'] = STATIC_MAX_AGE
+    metrics.install(app.server)
+    data_api.install(app.server, data_sets)
+    app.layout = build_layout(data_sets)
+    register_callbacks(app, data_sets)
+    print(f'app started in {time.perf_counter() - start:.3f}s')
+    return app
 
 
 # App layout
-def row_builder(row_number: int) -> dbc.Row:
+def row_builder(row_number: int, data_sets: dict[str, pd.DataFrame]) -> dbc.Row:
     """
     Builds a standard row based on row_number
 
@@ -62,6 +93,32 @@ def row_builder(row_number: int) -> dbc.Row:
                                   style={"width": "auto"}),
                     ],
                 ),
+                dbc.Col(
+                    id=f"graph-{row_number}-rolling-column",
+                    className="column",
+                    width=11,
+                    children=[
+                        html.H5(
+                            id=f"graph-{row_number}c-title",
+                            className="graph_title_text",
+                        ),
+                        dcc.Graph(id=f"graph-{row_number}-rolling",
+                                  style={"width": "auto"}),
+                    ],
+                ),
+                dbc.Col(
+                    id=f"graph-{row_number}-lag-column",
+                    className="column",
+                    width=11,
+                    children=[
+                        html.H5(
+                            id=f"graph-{row_number}d-title",
+                            className="graph_title_text",
+                        ),
+                        dcc.Graph(id=f"graph-{row_number}-lag",
+                                  style={"width": "auto"}),
+                    ],
+                ),
             ],
         ),
         dbc.Row(
@@ -96,6 +153,18 @@ def row_builder(row_number: int) -> dbc.Row:
                     ],
                 ),
                 html.Br(),
+                dbc.Col(
+                    children=[
+                        html.P("Region",
+                               className="general_text"),
+                        dcc.Dropdown(
+                            id=f"region-{row_number}",
+                            options=region_options(data_sets),
+                            value=data_sets.get('region', regions.DEFAULT_REGION),
+                            clearable=False,
+                        ),
+                    ]
+                ),
                 dbc.Col(
                     children=[
                         html.P("Show 7-Day Moving Avg",
@@ -120,6 +189,42 @@ def row_builder(row_number: int) -> dbc.Row:
                         ),
                     ]
                 ),
+                dbc.Col(
+                    children=[
+                        html.P("Rolling Window (Days)",
+                               className="general_text"),
+                        dcc.Slider(
+                            id=f"window-{row_number}",
+                            min=2,
+                            max=90,
+                            step=1,
+                            value=7,
+                            marks={days: str(days) for days in (2, 7, 14, 30, 60, 90)},
+                        ),
+                        dcc.RadioItems(
+                            id=f"statistic-{row_number}",
+                            className="general_text",
+                            options=[{'label': ' Mean ', 'value': 'mean'},
+                                     {'label': ' Standard Deviation', 'value': 'std'}],
+                            value='mean',
+                            labelStyle={'display': 'inline-block'},
+                        ),
+                    ]
+                ),
+                dbc.Col(
+                    children=[
+                        html.P("Largest Lag (Days)",
+                               className="general_text"),
+                        dcc.Slider(
+                            id=f"lag-{row_number}",
+                            min=1,
+                            max=data_loading.MAX_LAG,
+                            step=1,
+                            value=30,
+                            marks={days: str(days) for days in (1, 15, 30, 45, 60)},
+                        ),
+                    ]
+                ),
                 html.Br(),
             ]
         ),
@@ -128,94 +233,119 @@ def row_builder(row_number: int) -> dbc.Row:
                 html.Div(id=f"loading-output-{row_number}"), color="light"
             )
         ),
+        # the whole series for the clientside callback, sent once with the layout
+        dcc.Store(
+            id=f"series-{row_number}",
+            data=graph_updater.series_store(data_sets) if CLIENTSIDE_GRAPHS else None,
+        ),
     ], className="row-div"
     )
 
 
-# initiate the row
-row1 = row_builder(1)
-divider = html.Div(style={"height": "100px"})
+def region_options(data_sets: dict[str, pd.DataFrame]) -> list[str]:
+    """
+    The regions of the region selector, only their names are read when the app starts
+    """
+    if 'case regions' in data_sets:
+        return data_sets['case regions'].regions()
+    return [data_sets.get('region', regions.DEFAULT_REGION)]
 
-app.layout = html.Div(
-    id="root",
-    className="page_background",
-    children=[
-        html.Div(
-            id="body",
-            className="body",
-            children=[
-                html.H1(
-                    id="banner",
-                    className="top_banner",
-                    children=[
-                        "Pandemic’s Impact on the Sentiment of the Public",
-                    ],
-                ),
-                html.Div(
-                    id="project-description",
-                    children=[
-                        html.H5(
-                            className="intro_text",
-                            children=[
-                                html.H5(
-                                    "This project uses machine learning to analyse the \
-                                    sentiments of the public with respect to new daily cases."
-                                ),
-                                html.H5(
-                                    "The data is collected from the comment sections from the\
-                                    New York Times, from Feburary 2020 to December 2021"
-                                ),
-                                html.H5(['Github: ',
-                                        html.A('https://github.com/PierreLessard\
-                                                /Public-Morale-Over-Covid',
-                                                href='https://github.com/PierreLessard\
-                                                /Public-Morale-Over-Covid',
-                                                style={'color': 'white'})]),
-                                html.Br(),
-                            ],
-                        ),
-                    ],
-                ),
-                html.Br(),
-                html.H3(className="graph_title_text",
-                        children="Machine Learning Model Loss vs. Iteration"),
-                html.Div(
-                    dbc.Row(className="row",
-                            children=[graph_updater.update_main_graph(data_sets)],
-                            id="main-graph-container"),
-                    className='row-div'
-                ),
-                divider, row1, divider,
-            ],
-        )
-    ]
-)
+
+def build_layout(data_sets: dict[str, pd.DataFrame]) -> html.Div:
+    """
+    Builds the layout of the page around data_sets
+    """
+    # initiate the row
+    row1 = row_builder(1, data_sets)
+    divider = html.Div(style={"height": "100px"})
+
+    return html.Div(
+        id="root",
+        className="page_background",
+        children=[
+            html.Div(
+                id="body",
+                className="body",
+                children=[
+                    html.H1(
+                        id="banner",
+                        className="top_banner",
+                        children=[
+                            "Pandemic’s Impact on the Sentiment of the Public",
+                        ],
+                    ),
+                    html.Div(
+                        id="project-description",
+                        children=[
+                            html.H5(
+                                className="intro_text",
+                                children=[
+                                    html.H5(
+                                        "This project uses machine learning to analyse the \
+                                        sentiments of the public with respect to new daily cases."
+                                    ),
+                                    html.H5(
+                                        "The data is collected from the comment sections from the\
+                                        New York Times, from Feburary 2020 to December 2021"
+                                    ),
+                                    html.H5(['Github: ',
+                                            html.A('https://github.com/PierreLessard\
+                                                    /Public-Morale-Over-Covid',
+                                                    href='https://github.com/PierreLessard\
+                                                    /Public-Morale-Over-Covid',
+                                                    style={'color': 'white'})]),
+                                    html.Br(),
+                                ],
+                            ),
+                        ],
+                    ),
+                    html.Br(),
+                    html.H3(className="graph_title_text",
+                            children="Machine Learning Model Loss vs. Iteration"),
+                    html.Div(
+                        dbc.Row(className="row",
+                                children=[graph_updater.update_main_graph(data_sets)],
+                                id="main-graph-container"),
+                        className='row-div'
+                    ),
+                    divider, row1, divider,
+                ],
+            )
+        ]
+    )
 
 
 # User interactions
-@app.callback(
-    [
-        Output("graph-1a-title", "children"),
-        Output("graph-1b-title", "children"),
-        Output("graph-1", "figure"),
-        Output("graph-1-stats", "figure"),
-    ],
-    [
-        Input("date-1", "start_date"),
-        Input("date-1", "end_date"),
-        Input("case-1", "value"),
-        Input("historic-1", "value"),
-    ],
-)
-def update_graph(start_date: str, end_date: str,
-                 moving_avg: bool, historic: bool) -> tuple[px.line, px.line]:
+graph_outputs = [
+    Output("graph-1a-title", "children"),
+    Output("graph-1b-title", "children"),
+    Output("graph-1", "figure"),
+    Output("graph-1-stats", "figure"),
+    Output("loading-output-1", "children"),
+]
+graph_inputs = [
+    Input("date-1", "start_date"),
+    Input("date-1", "end_date"),
+    Input("case-1", "value"),
+    Input("historic-1", "value"),
+]
+
+
+@metrics.instrument('update_graph')
+def update_graph(data_sets: dict[str, pd.DataFrame], start_date: str, end_date: str,
+                 moving_avg: bool, historic: bool, partial: bool = False) -> tuple:
     """A generic function that can be used to update all graphs based on user input
     Graphs are generated with util.graph_updater.generate_graph, which returns
-    two plotly.express.line objects representing New Cases vs. Time and Sentiment vs. Time.
+    two line figures representing New Cases vs. Time and Sentiment vs. Time.
     The range of the data is from start_date to end_date
     Based on moving_avg and historic, traces of 7 day moving average and historical cases
     are added onto the graph.
+    With partial, the graphs already show figures and only their traces are sent
+    (see graph_updater.partial_figure).
     Returns a tuple containing the titile of the new graphs, and the new graph figures
+    The spinner wrapping loading-output-1 shows while this callback runs.
+    Its time and phases are recorded in util.metrics and served at /metrics.
+    With CLIENTSIDE_GRAPHS the browser runs assets/graphs.js instead.
     """
     title_a = "New Cases vs. Time"
     title_b = "Sentiment vs. Time"
@@ -226,28 +356,89 @@ def update_graph(start_date: str, end_date: str,
                                                         end_date),
                                                     moving_avg,
                                                     historic,)
-    return title_a, title_b, graph_a, graph_b
+    if partial:
+        graph_a, graph_b = graph_updater.partial_figure(graph_a), \
+            graph_updater.partial_figure(graph_b)
+    return title_a, title_b, graph_a, graph_b, None
 
 
-@app.callback(
-    Output("loading-output-1", "children"),
-    [
-        Input("date-1", "start_date"),
-        Input("date-1", "end_date"),
-        Input("case-1", "value"),
-        Input("historic-1", "value"),
-    ],
-)
-def load_output_1(a: Any, b: Any, c: Any, d: Any) -> None:
+@metrics.instrument('update_stats_graphs')
+def update_stats_graphs(data_sets: dict[str, pd.DataFrame], start_date: str, end_date: str,
+                        window: int, statistic: str, max_lag: int) -> tuple:
+    """Updates the rolling statistics and lag correlation graphs based on user input
+    The rolling mean or standard deviation (statistic) over window days and the
+    correlation between new cases and later sentiment up to max_lag days apart
+    are computed from the prefix sums of data_loading.daily_series for the days
+    from start_date to end_date.
+    Returns a tuple containing the titles of the two graphs and their figures
     """
-    Animates the loading symbol
+    start = datetime.datetime.fromisoformat(start_date)
+    end = datetime.datetime.fromisoformat(end_date)
+    label = 'Mean' if statistic == 'mean' else 'Standard Deviation'
+    return (f"{window}-Day Rolling {label} vs. Time",
+            "Correlation of New Cases and Later Sentiment vs. Lag",
+            graph_updater.build_rolling_graph(data_sets, start, end, window, statistic),
+            graph_updater.build_lag_graph(data_sets, start, end, max_lag))
+
+
+@metrics.instrument('update_series')
+def update_series(data_sets: dict[str, pd.DataFrame], region: str) -> dict:
+    """Returns the series of region for the clientside graph callback
+    The data sets of region are read by data_loading.region_data_sets when they
+    aren't in memory.
+    """
+    return graph_updater.series_store(data_loading.region_data_sets(data_sets, region))
+
+
+def register_callbacks(app: dash.Dash, data_sets: dict[str, pd.DataFrame]) -> None:
     """
-    if a or b or c or d:
-        time.sleep(1)
+    Registers the callbacks of the graphs of app, which are drawn from data_sets,
+    or from the data sets of the region selected in region-1
+    """
+    @app.callback(
+        [
+            Output("graph-1c-title", "children"),
+            Output("graph-1d-title", "children"),
+            Output("graph-1-rolling", "figure"),
+            Output("graph-1-lag", "figure"),
+        ],
+        [
+            Input("date-1", "start_date"),
+            Input("date-1", "end_date"),
+            Input("window-1", "value"),
+            Input("statistic-1", "value"),
+            Input("lag-1", "value"),
+            Input("region-1", "value"),
+        ],
+    )
+    def update_stats_graphs_1(start_date: str, end_date: str, window: int, statistic: str,
+                              max_lag: int, region: str) -> tuple:
+        return update_stats_graphs(data_loading.region_data_sets(data_sets, region),
+                                   start_date, end_date, window, statistic, max_lag)
+
+    if CLIENTSIDE_GRAPHS:
+        # the layout already holds the series of the default region
+        @app.callback(Output("series-1", "data"), Input("region-1", "value"),
+                      prevent_initial_call=True)
+        def update_series_1(region: str) -> dict:
+            return update_series(data_sets, region)
+
+        app.clientside_callback(ClientsideFunction("graphs", "update_graph"), graph_outputs,
+                                [Input("series-1", "data")] + graph_inputs)
+        return
+
+    @app.callback(graph_outputs, graph_inputs + [Input("region-1", "value")])
+    def update_graph_1(start_date: str, end_date: str, moving_avg: bool, historic: bool,
+                       region: str) -> tuple:
+        # the first call draws the whole figures, later ones only replace their traces
+        return update_graph(data_loading.region_data_sets(data_sets, region),
+                            start_date, end_date, moving_avg, historic,
+                            partial=any(trigger['prop_id'] != '.'
+                                        for trigger in dash.callback_context.triggered))
 
 
 def run_app() -> None:
     """
-    Runs the app
+    Runs the app with the Flask development server
     """
-    app.run_server(debug=True)
\ No newline at end of file
+    create_app().run_server(debug=True)
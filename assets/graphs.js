@@ -0,0 +1,121 @@
+/* Clientside version of util.graph_updater.generate_graph, see app.CLIENTSIDE_GRAPHS.
+ * The series are sent once in a dcc.Store built by graph_updater.series_store,
+ * range slicing, downsampling and trace toggling then happen in the browser,
+ * so only the budgeted points of each trace are plotted. */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    graphs: {
+        update_graph: function (store, startDate, endDate, movingAvg, historic) {
+            const start = startDate.slice(0, 10);
+            const end = endDate.slice(0, 10);
+            const toggles = {moving_av: movingAvg, historic: historic};
+
+            // python's bisect_right (right) or bisect_left over sorted 'YYYY-MM-DD' strings
+            function bisect(dates, bound, right) {
+                let lo = 0;
+                let hi = dates.length;
+                while (lo < hi) {
+                    const mid = (lo + hi) >> 1;
+                    if (dates[mid] < bound || (right && dates[mid] === bound)) {
+                        lo = mid + 1;
+                    } else {
+                        hi = mid;
+                    }
+                }
+                return lo;
+            }
+
+            // numpy's argmax and argmin, the first nan wins like in numpy
+            function argBest(values, lo, hi, better) {
+                let best = lo;
+                for (let i = lo; i < hi; i++) {
+                    if (Number.isNaN(values[i])) {
+                        return i;
+                    }
+                    if (better(values[i], values[best])) {
+                        best = i;
+                    }
+                }
+                return best;
+            }
+
+            function mean(values, lo, hi) {
+                let sum = 0;
+                for (let i = lo; i < hi; i++) {
+                    sum += values[i];
+                }
+                return sum / (hi - lo);
+            }
+
+            // the indices kept by graph_updater.downsample_indices
+            function downsample(x, y, mode, budget) {
+                const n = y.length;
+                if (mode === null || n <= budget) {
+                    return null;
+                }
+                if (mode === 'minmax') {
+                    const buckets = budget >> 1;
+                    const edges = [];
+                    for (let i = 0; i < buckets; i++) {
+                        edges.push(Math.trunc(i * (n / buckets)));
+                    }
+                    edges.push(n);
+                    const kept = new Set();
+                    for (let i = 0; i < buckets; i++) {
+                        kept.add(argBest(y, edges[i], edges[i + 1], (a, b) => a < b));
+                        kept.add(argBest(y, edges[i], edges[i + 1], (a, b) => a > b));
+                    }
+                    return Array.from(kept).sort((a, b) => a - b);
+                }
+
+                const edges = [];
+                for (let i = 0; i < budget - 2; i++) {
+                    edges.push(Math.trunc(i * ((n - 2) / (budget - 2)) + 1));
+                }
+                edges.push(n - 1);
+                const kept = [0];
+                const areas = new Array(n);
+                for (let i = 0; i < budget - 2; i++) {
+                    const lo = edges[i];
+                    const hi = edges[i + 1];
+                    const nextHi = i + 2 < edges.length ? edges[i + 2] : n;
+                    const avgX = mean(x, hi, nextHi);
+                    const avgY = mean(y, hi, nextHi);
+                    const a = kept[i];
+                    for (let j = lo; j < hi; j++) {
+                        areas[j] = Math.abs((x[a] - avgX) * (y[j] - y[a])
+                                            - (x[a] - x[j]) * (avgY - y[a]));
+                    }
+                    kept.push(argBest(areas, lo, hi, (p, q) => p > q));
+                }
+                kept.push(n - 1);
+                return kept;
+            }
+
+            // start_date < Date < end_date, like graph_updater.date_slice, with every
+            // trace downsampled to the point budget and long ranges drawn with WebGL
+            // like graph_updater.fill_figure
+            function figure(series, skeleton) {
+                const lo = bisect(series.Date, start, true);
+                const hi = Math.max(lo, bisect(series.Date, end, false));
+                const dates = series.Date.slice(lo, hi);
+                const days = dates.map(Date.parse);
+                const type = dates.length > store['webgl points'] ? {type: 'scattergl'} : {};
+                const data = skeleton.traces
+                    .filter(t => t.toggle === null || toggles[t.toggle])
+                    .map(function (t) {
+                        const y = series[t.column].slice(lo, hi)
+                            .map(v => v === null ? NaN : v);
+                        const kept = downsample(days, y, store.downsample, store['point budget']);
+                        return Object.assign({}, t.trace, type, kept === null
+                            ? {x: dates, y: y}
+                            : {x: kept.map(i => dates[i]), y: kept.map(i => y[i])});
+                    });
+                return {data: data, layout: skeleton.layout};
+            }
+
+            return ["New Cases vs. Time", "Sentiment vs. Time",
+                    figure(store.case, store['case figure']),
+                    figure(store.sentiment, store['sentiment figure']), null];
+        }
+    }
+});
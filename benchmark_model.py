@@ -0,0 +1,221 @@
+"""Throughput benchmarks for the sentiment scoring path
+
+Scores fixed, seeded samples of data/comments in three modes:
+    - single: sentiment_model.model_predict_sentiment once per comment (the old path)
+    - batched: sentiment_model.model_predict_sentiments
+    - pipeline: predict_model.fold_daily_stats, scoring plus date parsing and aggregation
+swept across batch size, process count and comment length bucket. Every configuration
+runs in a freshly spawned process that only gets its sample, so its peak RSS is its own
+and not that of the harness holding the whole corpus, the peak RSS of the largest
+worker is reported apart. Latencies are the time of each textcat batch, counted once
+for every comment in it, in the single mode the time of each call. Results are written as json to
+data/benchmarks and two result files can be compared with compare_results.
+"""
+import datetime
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+from typing import Optional
+import numpy as np
+import pandas as pd
+import predict_model
+from models import sentiment_model
+
+BENCHMARK_PATH = os.path.join('data', 'benchmarks')
+# comment lengths in characters, upper bounds are exclusive
+LENGTH_BUCKETS = {'short': (0, 200), 'medium': (200, 800), 'long': (800, 1_000_000)}
+
+
+def load_samples(size: int = 500, seed: int = 0,
+                 direc: str = 'data/comments') -> dict[str, pd.DataFrame]:
+    """
+    returns the same size comments for each length bucket on every run,
+    drawn with seed from all the comment files in direc
+    """
+    comments = pd.concat([pd.read_csv(f'{direc}/{file}') for file in sorted(os.listdir(direc))],
+                         ignore_index=True).dropna()
+    lengths = comments['Comments'].str.len()
+    samples = {}
+    for bucket, (low, high) in LENGTH_BUCKETS.items():
+        candidates = comments[(lengths >= low) & (lengths < high)]
+        samples[bucket] = candidates.sample(min(size, len(candidates)), random_state=seed)
+    return samples
+
+
+def run_benchmarks(direc: str = 'models/sentiment/saved_models/model50', size: int = 500,
+                   batch_sizes: tuple = (1, 32, 256), processes: Optional[tuple] = None,
+                   modes: tuple = ('single', 'batched', 'pipeline'),
+                   output: Optional[str] = None) -> list[dict]:
+    """
+    runs every mode over every length bucket, batched modes also over every batch size
+    and process count (1 and all cores by default), then writes the results to output
+    returns the list of results
+    """
+    processes = processes or tuple(sorted({1, os.cpu_count()}))
+    samples = load_samples(size)
+    configs = []
+    for bucket in samples:
+        if 'single' in modes:
+            configs.append({'mode': 'single', 'bucket': bucket, 'batch size': 1, 'processes': 1})
+        for mode in ('batched', 'pipeline'):
+            if mode in modes:
+                configs.extend({'mode': mode, 'bucket': bucket, 'batch size': batch_size,
+                                'processes': n_process}
+                               for batch_size in batch_sizes for n_process in processes)
+
+    results = []
+    context = mp.get_context('spawn')
+    for config in configs:
+        queue = context.Queue()
+        worker = context.Process(target=_run_config,
+                                 args=(queue, direc, samples[config['bucket']], config))
+        worker.start()
+        result = queue.get()
+        worker.join()
+        print(result)
+        results.append(result)
+
+    output = output or os.path.join(
+        BENCHMARK_PATH, f'sentiment_{datetime.datetime.now():%Y_%m_%d_%H%M%S}.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'environment': _environment(direc), 'results': results}, f, indent=2)
+    return results
+
+
+def compare_results(old: str, new: str, tolerance: float = 0.1) -> list[dict]:
+    """
+    compares two result files configuration by configuration
+    returns the configurations whose comments/s dropped by more than tolerance
+    """
+    with open(old) as f:
+        before = {_config_key(result): result for result in json.load(f)['results']}
+    with open(new) as f:
+        after = json.load(f)['results']
+
+    regressions = []
+    for result in after:
+        previous = before.get(_config_key(result))
+        if previous is None:
+            continue
+        change = result['comments/s'] / previous['comments/s'] - 1
+        print(f'{_config_key(result)}: {previous["comments/s"]:.1f} -> '
+              f'{result["comments/s"]:.1f} comments/s ({change:+.1%})')
+        if change < -tolerance:
+            regressions.append({**result, 'change': change})
+    return regressions
+
+
+def _run_config(queue: mp.Queue, direc: str, sample: pd.DataFrame, config: dict) -> None:
+    """runs one configuration in a fresh process and puts its result on queue"""
+    model = sentiment_model.open_model(direc)
+    txts = sample['Comments'].tolist()
+    batch_size, n_process = config['batch size'], config['processes']
+    batches = mp.get_context('fork').SimpleQueue()
+    _time_textcat(model, batches)
+    latencies, worker_peaks = [], {}
+    # drained while the configuration runs so forked workers never block on a full pipe
+    drain = threading.Thread(target=_drain_latencies, args=(batches, latencies, worker_peaks))
+    drain.start()
+
+    start = time.perf_counter()
+    if config['mode'] == 'single':
+        # model(txt) runs the textcat without its pipe, so each call is timed instead
+        for txt in txts:
+            begin = time.perf_counter()
+            sentiment_model.model_predict_sentiment(model, txt)
+            latencies.append(time.perf_counter() - begin)
+    elif config['mode'] == 'batched':
+        sentiment_model.model_predict_sentiments(model, txts, batch_size, n_process)
+    else:
+        scorer = predict_model.SentimentScorer(model, batch_size=batch_size, n_process=n_process)
+        predict_model.fold_daily_stats(scorer, iter([sample]))
+    seconds = time.perf_counter() - start
+    batches.put(None)
+    drain.join()
+
+    result = {**config, 'comments': len(txts), 'seconds': seconds,
+              'comments/s': len(txts) / seconds,
+              'peak rss mb': _peak_rss_kb() / 1024}
+    worker_peaks.pop(os.getpid(), None)
+    if worker_peaks:
+        result['peak worker rss mb'] = max(worker_peaks.values()) / 1024
+    # the fast tier has no textcat to time, so only its single mode has latencies
+    if latencies:
+        result['p50 latency ms'] = float(np.percentile(latencies, 50) * 1000)
+        result['p99 latency ms'] = float(np.percentile(latencies, 99) * 1000)
+    queue.put(result)
+
+
+def _time_textcat(model, batches: mp.SimpleQueue) -> None:
+    """
+    wraps the textcat of model so the size and time of every batch it scores are put on
+    batches, also from the workers forked by model_predict_sentiments
+    models without a textcat (the fast tier) are left as they are
+    """
+    if not hasattr(model, 'get_pipe'):
+        return
+    textcat = model.get_pipe('textcat')
+    pipe = textcat.pipe
+
+    def timed_pipe(docs, *args, **kwargs):
+        docs = list(docs)
+        begin = time.perf_counter()
+        scored = list(pipe(docs, *args, **kwargs))
+        batches.put((len(docs), time.perf_counter() - begin, os.getpid(), _peak_rss_kb()))
+        return scored
+    textcat.pipe = timed_pipe
+
+
+def _drain_latencies(batches: mp.SimpleQueue, latencies: list[float],
+                     peaks: dict[int, int]) -> None:
+    """
+    adds the time of every batch once per comment in it to latencies and the peak RSS
+    of the process that scored it to peaks, until a None
+    """
+    for item in iter(batches.get, None):
+        size, seconds, pid, peak_kb = item
+        latencies.extend([seconds] * size)
+        peaks[pid] = max(peaks.get(pid, 0), peak_kb)
+
+
+def _peak_rss_kb() -> int:
+    """
+    peak RSS of this process in kB
+    ru_maxrss survives the exec of a spawned process and would report the harness,
+    VmHWM starts over with the new program
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _config_key(result: dict) -> str:
+    """identifies a configuration across result files"""
+    return f'{result["mode"]}/{result["bucket"]}/b{result["batch size"]}/p{result["processes"]}'
+
+
+def _environment(direc: str) -> dict:
+    """records what the results depend on so runs can be compared fairly"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'model': direc, 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'machine': platform.machine(),
+            'time': datetime.datetime.now().isoformat()}
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -1,22 +1,100 @@
 """code structure taken from """
-import pickle
-from spacy.tokens import Token
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from spacy.tokens import Doc, Token
 from spacy.lang.en import English as Parser
 import nltk
 from nltk.corpus import wordnet as wn
 import gensim
 from gensim import corpora
-from typing import Optional
-from functools import reduce
+from gensim.matutils import dirichlet_expectation
+from typing import Iterable, Iterator, Optional
+from functools import lru_cache, reduce
+from itertools import islice
+from models import model_registry
+
+# directory of the lda model and its dictionary, found from any working directory
+TOPIC_DIREC = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'covid_topic_labelling')
+# the corpus vocabulary is small, so this holds every distinct word in practice
+LEMMA_CACHE_SIZE = 2 ** 16
+# texts tokenized per nlp.pipe call
+PREPROCESS_BATCH_SIZE = 1000
+
+
+class TopicPreprocessor:
+    """
+    Turns texts into the lemmatized, stopword free tokens the lda model was trained on.
+    Build it once and reuse it, the spacy tokenizer and the stopwords are only loaded here.
+
+    Instance Attributes:
+        - nlp: the blank english spacy pipeline used to tokenize
+        - stop_words: words dropped from every text
+        - batch_size: texts tokenized per nlp.pipe call
+    """
+    nlp: Parser
+    stop_words: frozenset[str]
+    batch_size: int
+
+    def __init__(self, stop_words: Optional[Iterable[str]] = None,
+                 batch_size: int = PREPROCESS_BATCH_SIZE) -> None:
+        self.nlp = Parser()
+        if stop_words is None:
+            download_nltk_data()
+            stop_words = nltk.corpus.stopwords.words('english')
+        self.stop_words = frozenset(stop_words)
+        self.batch_size = batch_size
+
+    def prepare(self, text: str) -> list[str]:
+        """prepares a single text, same as prepare_text_for_lda"""
+        return self._filter(_doc_tokens(self.nlp(text)))
+
+    def prepare_many(self, texts: Iterable[str]) -> Iterator[list[str]]:
+        """
+        prepares every text of a list or stream, tokenizing batch_size texts at a time
+        yields the tokens of each text in order
+        """
+        for doc in self.nlp.pipe(texts, batch_size=self.batch_size):
+            yield self._filter(_doc_tokens(doc))
+
+    def prepare_docs(self, docs: Iterable[Doc]) -> Iterator[list[str]]:
+        """
+        prepares texts another english spacy tokenizer already made into docs,
+        so a pipeline that tokenizes for its own model doesn't tokenize twice
+        """
+        for doc in docs:
+            yield self._filter(_doc_tokens(doc))
+
+    def _filter(self, tokens: list[str]) -> list[str]:
+        """lemma-izes tokens and removes short and stop words"""
+        return [get_lemma(t) for t in tokens if len(t) > 4 and t not in self.stop_words]
+
+
+# preprocessor shared by the single text functions of this process, see get_preprocessor
+_preprocessor = None
+
+
+def get_preprocessor() -> TopicPreprocessor:
+    """returns the preprocessor of this process, building it on first use"""
+    global _preprocessor
+    if _preprocessor is None:
+        _preprocessor = TopicPreprocessor()
+    return _preprocessor
 
 
 def tokenize(text: str) -> list[Token]:
     """
     tokenizes the text to be easily vectorized/lemma/stopped/stemmed later
     """
-    tokenizer = Parser()
+    return _doc_tokens(get_preprocessor().nlp(text))
+
+
+def _doc_tokens(doc: Doc) -> list[str]:
+    """lower cased tokens of doc without whitespace, urls and screen names replaced"""
     res = []
-    for token in tokenizer(text):
+    for token in doc:
         if token.orth_.isspace():
             continue
         elif token.like_url:
@@ -28,57 +106,97 @@ def tokenize(text: str) -> list[Token]:
     return res
 
 
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
 def get_lemma(word: str) -> str:
     """ returns the lemma of a word (simplifies word as possible)"""
     return wn.morphy(word) or word
-    
+
 
 def prepare_text_for_lda(text: str) -> list[Token]:
     """
     main function to prepare text for lda
     lemma-izes words and removes stop words
+    for many texts use TopicPreprocessor.prepare_many
     """
-    stop_words = set(nltk.corpus.stopwords.words('english'))
-    return [get_lemma(t) for t in tokenize(text) if len(t) > 4 and t not in stop_words]
+    return get_preprocessor().prepare(text)
 
 
 def load_training_data(direc: str = 'data/training/training_articles.csv') -> list:
     """
     opens text file with sample articles to train and tokenizes
+    for corpora that don't fit in memory use stream_training_data
+    """
+    return list(stream_training_data(direc))
+
+
+def stream_training_data(direc: str = 'data/training/training_articles.csv') -> Iterator[list[str]]:
+    """
+    yields the tokens of each line of the text file at direc,
+    only batch_size lines of the file are held at once
     """
     with open(direc) as f:
-        return [prepare_text_for_lda(line) for line in f]
+        yield from get_preprocessor().prepare_many(f)
+
+
+def stream_comment_data(direc: str = 'data/comments', chunksize: int = 10_000) -> Iterator[list[str]]:
+    """
+    yields the tokens of every comment in the comment files of direc,
+    reading chunksize rows at a time, for training on the comment archive
+    """
+    for file in sorted(os.listdir(direc)):
+        for chunk in pd.read_csv(f'{direc}/{file}', usecols=['Comments'], chunksize=chunksize):
+            yield from get_preprocessor().prepare_many(chunk['Comments'].dropna().astype(str))
 
 
-def train_lda_model(data: Optional[str] = None, direc: str = 'covid_topic_labelling/other_models') -> None:
+def train_lda_model(data: Optional[str] = None, direc: str = os.path.join(TOPIC_DIREC, 'other_models'),
+                    documents: Optional[Iterable[list[str]]] = None, num_topics: int = 10,
+                    passes: int = 15, workers: Optional[int] = None,
+                    chunksize: int = 2000) -> None:
     """
-    Input data,
-    save model to direc
+    Input data (a text file with one document per line) or an iterable of tokenized
+    documents such as stream_comment_data(), save model to direc
+    documents are streamed once to build the dictionary and write the corpus to
+    direc/corpus.mm (Matrix Market with an offset index), which training then reads
+    from disk pass after pass, so memory doesn't grow with the size of the corpus
+    training runs on workers processes (all cores but one by default)
     """
-    tokenized_data = load_training_data(data) if data else load_training_data()
-    dct = corpora.Dictionary(tokenized_data)
-    corpus = [dct.doc2bow(tokens) for tokens in tokenized_data]
-    pickle.dump(corpus, open(f'{direc}/corpus.pkl', 'wb'))
+    if documents is None:
+        documents = stream_training_data(data) if data else stream_training_data()
+    dct = corpora.Dictionary()
+    corpora.MmCorpus.serialize(f'{direc}/corpus.mm',
+                               (dct.doc2bow(tokens, allow_update=True) for tokens in documents))
     dct.save(f'{direc}/dictionary.gensim')
+    corpus = corpora.MmCorpus(f'{direc}/corpus.mm')
 
-    model = gensim.models.ldamodel.LdaModel(corpus, num_topics=10, id2word=dct, passes=15)
+    workers = workers or max(os.cpu_count() - 1, 1)
+    model = gensim.models.ldamulticore.LdaMulticore(corpus, num_topics=num_topics, id2word=dct,
+                                                    passes=passes, workers=workers,
+                                                    chunksize=chunksize)
     model.save(f'{direc}/model.gensim')
 
     for c, topic in enumerate(model.print_topics(num_words=20)):
         print(f'Topic {c} Words: {topic}\n\n')
 
 
-def load_model(direc: str = 'covid_topic_labelling') -> tuple:
+def load_model(direc: str = TOPIC_DIREC) -> tuple:
     """
     loads model from direc
     returns (dicitonary,model)
     """
-    nltk.download('wordnet')
-    nltk.download('stopwords')
+    download_nltk_data()
     return(gensim.corpora.Dictionary.load(f'{direc}/dictionary.gensim'),
            gensim.models.ldamodel.LdaModel.load(f'{direc}/model.gensim'))
 
 
+def download_nltk_data() -> None:
+    """downloads the nltk corpora used for preprocessing unless they are already installed"""
+    for resource, path in (('wordnet', 'corpora/wordnet'), ('stopwords', 'corpora/stopwords')):
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            nltk.download(resource)
+
+
 def predict_covid_label(txt: str, model, dct) -> float:
     """
     returns a value from 0-1 indicating predicated probablity of 
@@ -88,15 +206,110 @@ def predict_covid_label(txt: str, model, dct) -> float:
     # tokenize text
     tokenized_txt = prepare_text_for_lda(txt)
 
-    return reduce(lambda x, y: x + y[1], model.get_document_topics(dct.doc2bow(tokenized_txt))[-2:], 0)
+    return _covid_probability(model, dct.doc2bow(tokenized_txt))
+
+
+def predict_covid_labels(txts: Iterable[str], model, dct,
+                         preprocessor: Optional[TopicPreprocessor] = None,
+                         batch_size: int = PREPROCESS_BATCH_SIZE) -> Iterator[float]:
+    """
+    batched version of predict_covid_label for lists or streams of texts,
+    texts are preprocessed batch_size at a time with preprocessor (the shared one by default)
+    and scored together by covid_scores
+    yields a covid score for every text in the same order as txts
+    the scores are not those of predict_covid_label: covid_scores starts inference from
+    fixed instead of random topic weights, so on real comments they can differ by about
+    0.5, measure the gap on a sample with compare_covid_scores
+    """
+    preprocessor = preprocessor or get_preprocessor()
+    txts = iter(txts)
+    while True:
+        batch = list(islice(txts, batch_size))
+        if not batch:
+            return
+        yield from covid_scores([dct.doc2bow(tokens) for tokens in preprocessor.prepare_many(batch)],
+                                model, len(dct)).tolist()
+
+
+def _covid_probability(model, bow: list[tuple[int, int]]) -> float:
+    """sums the probabilities of the last two topics of bow, the covid topics"""
+    return reduce(lambda x, y: x + y[1], model.get_document_topics(bow)[-2:], 0)
+
+
+def bows_to_matrix(bows: list[list[tuple[int, int]]], num_terms: int) -> sparse.csr_matrix:
+    """stacks bag of words documents into a sparse (documents x terms) count matrix"""
+    lengths = np.fromiter((len(bow) for bow in bows), dtype=np.int64, count=len(bows))
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    pairs = np.array([pair for bow in bows for pair in bow], dtype=np.int64).reshape(-1, 2)
+    return sparse.csr_matrix((pairs[:, 1], pairs[:, 0], indptr), shape=(len(bows), num_terms))
+
+
+def covid_scores(bows: list[list[tuple[int, int]]], model, num_terms: int) -> np.ndarray:
+    """
+    vectorized version of _covid_probability for a batch of bag of words documents
+    runs the same variational inference as model.get_document_topics on every document
+    at once with the model's saved expElogbeta, each document stops updating once it
+    converges, just as it would alone
+    gensim starts each document from random topic weights, here they start from their
+    expected value of 1, so scores differ from the per document path by about as much
+    as two calls of the per document path differ from each other
+    returns the covid relatedness of each document, from 0-1
+    """
+    counts = bows_to_matrix(bows, num_terms).astype(model.dtype)
+    exp_elog_beta = model.expElogbeta
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    # expElogbeta of the term of every nonzero count
+    beta_nonzero = exp_elog_beta[:, counts.indices].T
+
+    gamma = np.ones((counts.shape[0], model.num_topics), dtype=model.dtype)
+    exp_elog_theta = np.exp(dirichlet_expectation(gamma))
+    active = np.ones(counts.shape[0], dtype=bool)
+    # gensim smooths phinorm by the machine epsilon of the model's dtype
+    epsilon = np.finfo(model.dtype).eps
+    for _ in range(model.iterations):
+        phinorm = np.einsum('nk,nk->n', exp_elog_theta[rows], beta_nonzero) + epsilon
+        weighted = sparse.csr_matrix((counts.data / phinorm, counts.indices, counts.indptr),
+                                     shape=counts.shape)
+        new_gamma = model.alpha + exp_elog_theta * (weighted @ exp_elog_beta.T)
+        converged = np.mean(np.abs(new_gamma - gamma), axis=1) < model.gamma_threshold
+        gamma[active] = new_gamma[active]
+        exp_elog_theta[active] = np.exp(dirichlet_expectation(gamma[active]))
+        active &= ~converged
+        if not active.any():
+            break
+
+    # like get_document_topics, only topics above the minimum probability are listed
+    # and the last two listed are summed
+    topics = gamma / gamma.sum(axis=1, keepdims=True)
+    listed = topics >= max(model.minimum_probability, 1e-8)
+    listed_after = np.cumsum(listed[:, ::-1], axis=1)[:, ::-1]
+    return np.where(listed & (listed_after <= 2), topics, 0).sum(axis=1)
+
+
+def compare_covid_scores(txts: list[str], model, dct) -> dict[str, float]:
+    """
+    validates covid_scores against predict_covid_label on txts, expect the
+    differences of two runs of predict_covid_label (see covid_scores)
+    returns the largest and mean absolute differences and the speed of both paths
+    """
+    start = time.perf_counter()
+    single = np.array([predict_covid_label(txt, model, dct) for txt in txts])
+    single_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    batched = np.fromiter(predict_covid_labels(txts, model, dct), dtype=float, count=len(txts))
+    batched_seconds = time.perf_counter() - start
+    return {'max difference': float(np.max(np.abs(single - batched))),
+            'mean difference': float(np.mean(np.abs(single - batched))),
+            'single texts/s': len(txts) / single_seconds,
+            'batched texts/s': len(txts) / batched_seconds}
 
 
 def load_and_predict(txt: str, direc: Optional[str] = None) -> float:
     """
     Function that combines the loading and predicting
-    Not recommended to use on lots of data as ineffecient
+    the model is loaded once per process and kept in model_registry.REGISTRY
     """
-    dct, model = load_model() if not direc else load_model(direc)
+    dct, model = model_registry.REGISTRY.get(direc or TOPIC_DIREC, load_model)
     return predict_covid_label(txt, model, dct)
 
 
@@ -115,6 +328,8 @@ if __name__ == '__main__':
     print(predict_covid_label(txt, model, dct))  # should return high percentage
     print(predict_covid_label(txt2, model, dct))  # should return low percentage
     print(load_and_predict(txt))
+    print(list(predict_covid_labels([txt, txt2], model, dct)))  # same as above
+    print(compare_covid_scores([txt, txt2] * 100, model, dct))
 
     # python-ta
     import python_ta
@@ -0,0 +1,76 @@
+"""In-process registry that loads each model artifact once and keeps it warm
+
+Models are keyed by their absolute directory, so different versions of the same
+model can be resident at once. Past max_models the least recently used model is
+dropped. Load times are recorded so slow artifacts show up.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+MAX_MODELS = 4
+
+
+class ModelRegistry:
+    """
+    Least recently used cache of loaded models
+
+    Instance Attributes:
+        - max_models: number of models kept loaded at once
+        - load_times: seconds each directory took to load, kept after eviction
+
+    Representation Invariants:
+        - self.max_models > 0
+    """
+    max_models: int
+    load_times: dict[str, float]
+
+    def __init__(self, max_models: int = MAX_MODELS) -> None:
+        self.max_models = max_models
+        self.load_times = {}
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, direc: str, loader: Callable[[str], Any]) -> Any:
+        """
+        returns the model loaded from direc, calling loader(direc) only
+        the first time or after the model has been evicted
+        """
+        key = os.path.abspath(direc)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+
+            start = time.perf_counter()
+            model = loader(direc)
+            self.load_times[key] = time.perf_counter() - start
+            self._models[key] = model
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+            return model
+
+    def preload(self, models: dict[str, Callable[[str], Any]]) -> dict[str, float]:
+        """
+        loads every directory in models with its loader, for use at startup
+        returns the load time of each directory
+        """
+        for direc, loader in models.items():
+            self.get(direc, loader)
+        return {direc: self.load_times[os.path.abspath(direc)] for direc in models}
+
+    def loaded(self) -> list[str]:
+        """returns the directories currently loaded, least recently used first"""
+        with self._lock:
+            return list(self._models)
+
+    def clear(self) -> None:
+        """drops every loaded model"""
+        with self._lock:
+            self._models.clear()
+
+
+# registry shared by the sentiment and topic models of this process
+REGISTRY = ModelRegistry()
@@ -0,0 +1,174 @@
+"""on disk cache of sentiment scores so re-runs of predict_model only score new comments
+
+scores are keyed by a hash of the normalized comment text and a fingerprint of the
+model directory, so a retrained model never reuses scores of an older one
+"""
+import hashlib
+import os
+import sqlite3
+import time
+import unicodedata
+from typing import Iterable
+from models import sentiment_model
+from util import sqlite_util
+
+CACHE_PATH = os.path.join('data', os.path.join('prediction_outputs', 'sentiment_cache.sqlite3'))
+MAX_ENTRIES = 2_000_000
+# share of max_entries freed by each eviction, so the full count of the
+# entries is only taken again after that many new scores
+EVICT_FRACTION = 0.1
+
+
+def normalize_text(txt: str) -> str:
+    """
+    normalizes a comment for hashing
+    only the unicode form is normalized, whitespace is kept as is because
+    the tokenizer turns runs of whitespace into tokens that change the score
+    """
+    return unicodedata.normalize('NFC', str(txt))
+
+
+def text_key(txt: str) -> str:
+    """returns the hex sha1 of the normalized text"""
+    return hashlib.sha1(normalize_text(txt).encode('utf-8')).hexdigest()
+
+
+def model_fingerprint(direc: str = sentiment_model.SENTIMENT_DIREC) -> str:
+    """
+    hashes every file in the model directory (relative path and contents)
+    so any change to the saved model changes the fingerprint
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(direc):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, direc).encode('utf-8'))
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+class SentimentCache:
+    """
+    sqlite backed cache of sentiment scores with least recently used eviction
+
+    Instance Attributes:
+        - path: location of the sqlite file
+        - max_entries: number of scores kept before the oldest are evicted
+        - hits: number of lookups answered by the cache
+        - misses: number of lookups that needed inference
+
+    Representation Invariants:
+        - self.max_entries > 0
+    """
+    path: str
+    max_entries: int
+    hits: int
+    misses: int
+
+    def __init__(self, path: str = CACHE_PATH, max_entries: int = MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS scores ('
+                           'key TEXT NOT NULL, model TEXT NOT NULL, sentiment REAL NOT NULL, '
+                           'last_used REAL NOT NULL, PRIMARY KEY (key, model))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        self._conn.commit()
+        # running count of the entries, kept from the inserts and deletes of this connection
+        self._entries = len(self)
+
+    def get_many(self, keys: list[str], model: str) -> dict[str, float]:
+        """returns the cached scores of keys for the model, missing keys are left out"""
+        found = dict(sqlite_util.select_in(
+            self._conn, 'SELECT key, sentiment FROM scores WHERE model = ? AND key IN ({})',
+            keys, (model,)))
+        if found:
+            now = time.time()
+            self._conn.executemany('UPDATE scores SET last_used = ? WHERE key = ? AND model = ?',
+                                   [(now, key, model) for key in found])
+            self._conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, scores: dict[str, float], model: str) -> None:
+        """stores the scores for the model and evicts the oldest entries if over capacity"""
+        now = time.time()
+        rows = [(key, model, value, now) for key, value in scores.items()]
+        self._conn.executemany('UPDATE scores SET sentiment = ?, last_used = ? '
+                               'WHERE key = ? AND model = ?',
+                               [(value, now, key, model) for key, value in scores.items()])
+        # only the rows that weren't there yet are inserted and counted
+        inserted = self._conn.executemany('INSERT OR IGNORE INTO scores VALUES (?, ?, ?, ?)', rows)
+        self._entries += max(inserted.rowcount, 0)
+        self._conn.commit()
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        once the running count of entries is over max_entries, counts them again (other
+        processes may share the file) and drops the least recently used entries until
+        at most max_entries * (1 - EVICT_FRACTION) remain
+        returns the number of entries removed
+        """
+        if self._entries <= self.max_entries:
+            return 0
+        self._entries = len(self)
+        if self._entries <= self.max_entries:
+            return 0
+        excess = self._entries - int(self.max_entries * (1 - EVICT_FRACTION))
+        deleted = self._conn.execute('DELETE FROM scores WHERE rowid IN '
+                                     '(SELECT rowid FROM scores ORDER BY last_used LIMIT ?)',
+                                     (excess,)).rowcount
+        self._conn.commit()
+        self._entries -= deleted
+        return deleted
+
+    def stats(self) -> dict[str, float]:
+        """returns the hit/miss counters and the current size of the cache"""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self),
+                'hit rate': self.hits / total if total else 0.0}
+
+    def close(self) -> None:
+        """closes the connection to the sqlite file"""
+        self._conn.close()
+
+    def __len__(self) -> int:
+        return self._conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+
+
+def cached_predict_sentiments(model, txts: Iterable[str], cache: SentimentCache, fingerprint: str,
+                              batch_size: int = sentiment_model.BATCH_SIZE,
+                              n_process: int = sentiment_model.N_PROCESS,
+                              policy: str = sentiment_model.LENGTH_POLICY) -> list[float]:
+    """
+    same contract as sentiment_model.model_predict_sentiments, but only texts
+    whose normalized hash is not cached for fingerprint go through the model
+    texts repeated within txts are scored once
+    scores of a length policy other than 'none' are cached apart from the full scores
+    txts may also be Docs, they are keyed by their text
+    """
+    txts = list(txts)
+    keys = [text_key(sentiment_model.doc_text(txt)) for txt in txts]
+    if policy != 'none':
+        fingerprint = f'{fingerprint}/{policy}'
+    scores = cache.get_many(list(dict.fromkeys(keys)), fingerprint)
+
+    todo = {}
+    for key, txt in zip(keys, txts):
+        if key not in scores and key not in todo:
+            todo[key] = txt
+    if todo:
+        new_scores = dict(zip(todo, sentiment_model.model_predict_sentiments(
+            model, todo.values(), batch_size, n_process, policy)))
+        cache.put_many(new_scores, fingerprint)
+        scores.update(new_scores)
+
+    return [scores[key] for key in keys]
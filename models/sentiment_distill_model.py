@@ -0,0 +1,152 @@
+"""Distills the spacy textcat into the fast hashing vectorizer + logistic regression tier.
+The teacher labels are the spacy scores already written to data/prediction_outputs.
+predicted_sentiment files with a Key column (see dedupe.comment_key) are joined to
+their comments file on it, since deduplication drops rows before scoring, older
+files without one line up row for row with their comments file.
+"""
+import os
+import sys
+import time
+from random import Random
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+from models import sentiment_model
+from util import dedupe
+
+# features of the fast tier, unigrams agree with the spacy model as often as
+# unigrams and bigrams while costing half as much to vectorize
+NGRAM_RANGE = (1, 1)
+N_FEATURES = 2 ** 18
+# other (ngram_range, n_features) measured by distill for the trade-off in its report
+TRADE_OFFS = (((1, 2), 2 ** 18), ((1, 1), 2 ** 16), ((1, 1), 2 ** 14))
+
+
+def load_distillation_data(comments_direc: str = 'data/comments',
+                           predictions_direc: str = 'data/prediction_outputs') -> tuple[list, list]:
+    """
+    pairs every comments file with its predicted_sentiment file
+    returns (comments, spacy scores), comments without a score are left out and
+    files without a Key column whose row counts differ are skipped
+    """
+    txts, scores = [], []
+    for file in sorted(os.listdir(comments_direc)):
+        prediction_file = f'{predictions_direc}/predicted_sentiment{file.strip("comments")}'
+        if not os.path.isfile(prediction_file):
+            continue
+        comments = pd.read_csv(f'{comments_direc}/{file}')
+        predictions = pd.read_csv(prediction_file)
+        if 'Key' in predictions.columns:
+            keys = [dedupe.comment_key(date, comment)
+                    for date, comment in zip(comments['Date'], comments['Comments'])]
+            comments = comments.assign(Key=keys).drop_duplicates('Key').merge(
+                predictions.drop_duplicates('Key')[['Key', 'Sentiment']], on='Key')
+            predictions = comments
+        elif len(comments) != len(predictions):
+            print(f'skipping {file}: {len(comments)} comments but {len(predictions)} predictions')
+            continue
+        txts.extend(comments['Comments'].fillna('').astype(str))
+        scores.extend(predictions['Sentiment'])
+    return txts, scores
+
+
+def train_fast_model(txts: list[str], scores: list[float], n_features: int = N_FEATURES,
+                     ngram_range: tuple[int, int] = NGRAM_RANGE,
+                     c: float = 4.0) -> sentiment_model.FastSentimentModel:
+    """
+    fits the logistic regression on whether the spacy model called each text positive,
+    weighting every text by how confident the spacy model was
+    """
+    vectorizer = HashingVectorizer(n_features=n_features, ngram_range=ngram_range,
+                                   alternate_sign=False, norm='l2')
+    scores = np.asarray(scores)
+    classifier = LogisticRegression(C=c, max_iter=1000)
+    classifier.fit(vectorizer.transform(txts), scores > 0, sample_weight=np.abs(scores))
+    return sentiment_model.FastSentimentModel(vectorizer, classifier.coef_[0],
+                                              float(classifier.intercept_[0]))
+
+
+def evaluate_fast_model(fast_model: sentiment_model.FastSentimentModel, txts: list[str],
+                        scores: list[float], teacher=None) -> dict[str, float]:
+    """
+    compares the fast model to the spacy scores of txts
+    agreement is the share of texts both models put on the same side of 0,
+    confident agreement only counts texts the spacy model scored beyond +-0.9
+    if the spacy teacher model is given its throughput is measured too
+    """
+    scores = np.asarray(scores)
+    start = time.perf_counter()
+    predictions = np.asarray(sentiment_model.model_predict_sentiments(fast_model, txts))
+    fast_seconds = time.perf_counter() - start
+    confident = np.abs(scores) > 0.9
+
+    results = {
+        'texts': len(txts),
+        'agreement': float(np.mean((predictions > 0) == (scores > 0))),
+        'confident agreement': float(np.mean((predictions > 0)[confident] == (scores > 0)[confident])),
+        'mean absolute error': float(np.mean(np.abs(predictions - scores))),
+        'correlation': float(np.corrcoef(predictions, scores)[0, 1]),
+        'fast comments/s': len(txts) / fast_seconds,
+    }
+    if teacher is not None:
+        sample = txts[:2000]
+        start = time.perf_counter()
+        sentiment_model.model_predict_sentiments(teacher, sample)
+        results['spacy comments/s'] = len(sample) / (time.perf_counter() - start)
+        results['speedup'] = results['fast comments/s'] / results['spacy comments/s']
+    return results
+
+
+def distill(direc: str = 'models/sentiment/saved_models/fast',
+            teacher_direc: str = 'models/sentiment/saved_models/model50',
+            split: float = .8, seed: int = 0,
+            trade_offs: tuple = TRADE_OFFS) -> dict[str, float]:
+    """
+    trains the fast model on split of the comment corpus, evaluates it on the rest
+    against the spacy scores, then saves the model and writes the report to direc
+    the report also lists the agreement and speedup of a model trained with each
+    (ngram_range, n_features) of trade_offs, none of which are saved
+    """
+    txts, scores = load_distillation_data()
+    order = list(range(len(txts)))
+    Random(seed).shuffle(order)
+    cut = int(len(order) * split)
+    train_txts, train_scores = [txts[i] for i in order[:cut]], [scores[i] for i in order[:cut]]
+    test_txts, test_scores = [txts[i] for i in order[cut:]], [scores[i] for i in order[cut:]]
+
+    fast_model = train_fast_model(train_txts, train_scores)
+    results = evaluate_fast_model(fast_model, test_txts, test_scores,
+                                  sentiment_model.open_model(teacher_direc))
+    fast_model.save(direc)
+    trade_off_results = {}
+    for ngram_range, n_features in trade_offs:
+        other = evaluate_fast_model(train_fast_model(train_txts, train_scores, n_features,
+                                                     ngram_range), test_txts, test_scores)
+        trade_off_results[(ngram_range, n_features)] = (
+            other['agreement'], other['fast comments/s'] / results['spacy comments/s'])
+
+    with open(f'{direc}/report.txt', 'w') as f:
+        f.write(f'Fast model distilled from {teacher_direc} on {cut} comments, '
+                f'evaluated on {len(test_txts)} held out comments\n')
+        f.write(f'ngram range: {NGRAM_RANGE}, n features: {N_FEATURES}\n')
+        for name, value in results.items():
+            f.write(f'{name}: {value:.4f}\n' if isinstance(value, float) else f'{name}: {value}\n')
+        f.write('\nother settings (ngram range, n features): agreement, speedup\n')
+        for (ngram_range, n_features), (agreement, speedup) in trade_off_results.items():
+            f.write(f'{ngram_range}, {n_features}: {agreement:.4f}, {speedup:.4f}\n')
+    return results
+
+
+if __name__ == "__main__":
+    # redistilling overwrites models/sentiment/saved_models/fast, so it needs the flag:
+    #     python -m models.sentiment_distill_model --distill
+    if '--distill' in sys.argv:
+        print(distill())
+
+    # python-ta
+    # import python_ta
+    # python_ta.check_all(config={
+    #     'max-line-length': 120,
+    #     'disable': ['R1705', 'C0200']
+    # })
@@ -1,27 +1,107 @@
 """file containing functions to operate sentiment model"""
+import json
+import multiprocessing as mp
+import os
+from typing import Iterable, Iterator, Union
+import numpy as np
 import spacy
+from sklearn.feature_extraction.text import HashingVectorizer
+from spacy.attrs import NORM, ORTH
+from spacy.tokens import Doc
+from spacy.util import minibatch
+from models import model_registry
 
+# large enough to amortize the textcat batch overhead
+BATCH_SIZE = 256
+N_PROCESS = 1
+# caps the tokens in a textcat batch so a batch of essays costs no more than one of tweets
+MAX_BATCH_TOKENS = 32_768
+# how long texts are scored, see parse_length_policy
+LENGTH_POLICY = 'none'
 
-def predict_sentiment(txt: str, direc: str = 'sentiment/saved_models/model50') -> float:
+# the models directory, so the default models are found from any working directory
+MODELS_PATH = os.path.dirname(os.path.realpath(__file__))
+SENTIMENT_DIREC = os.path.join(MODELS_PATH, 'sentiment', 'saved_models', 'model50')
+# directory of the fast tier distilled by sentiment_distill_model, and its files
+FAST_DIREC = os.path.join(MODELS_PATH, 'sentiment', 'saved_models', 'fast')
+FAST_WEIGHTS = 'weights.npz'
+FAST_CONFIG = 'vectorizer.json'
+# texts vectorized at once by the fast tier, it has no per text memory to bound
+FAST_BATCH_SIZE = 4096
+
+# model used by the worker processes of model_predict_sentiments, set by _init_worker
+_worker_model = None
+
+
+def predict_sentiment(txt: str, direc: str = SENTIMENT_DIREC) -> float:
     """
     predicts sentiment of string
-    only use for testing not good for large data because
-    model is loaded each time
+    the model is loaded once per process and kept in model_registry.REGISTRY,
+    for large data use model_predict_sentiments
     input is a txt string
     optional directory change for using different models
     returns a value from -1 to 1
     Aproaching -1 being a negative sentiment
     Aproaching 1 being a positive sentiment
     """
-    vals = spacy.load(direc)(txt).cats
-    return vals["pos"] if vals["pos"] > vals["neg"] else -1 * vals["neg"]
+    return model_predict_sentiment(model_registry.REGISTRY.get(direc, open_model), txt)
 
 
-def open_model(direc: str = 'sentiment/saved_models/model50'):
-    """opens model from optional directory string"""
+def open_model(direc: str = SENTIMENT_DIREC):
+    """
+    opens model from optional directory string
+    directories holding a distilled fast model (see FAST_DIREC) open as a
+    FastSentimentModel, anything else is loaded with spacy
+    """
+    if os.path.isfile(os.path.join(direc, FAST_WEIGHTS)):
+        return FastSentimentModel.load(direc)
     return spacy.load(direc)
 
 
+class FastSentimentModel:
+    """
+    hashing vectorizer + logistic regression distilled from the spacy textcat
+    scores with the same -1 to 1 contract, many times faster
+
+    Instance Attributes:
+        - vectorizer: the stateless hashing vectorizer
+        - coef: weight of each hashed feature
+        - intercept: bias of the logistic regression
+    """
+    vectorizer: HashingVectorizer
+    coef: np.ndarray
+    intercept: float
+
+    def __init__(self, vectorizer: HashingVectorizer, coef: np.ndarray, intercept: float) -> None:
+        self.vectorizer = vectorizer
+        self.coef = coef
+        self.intercept = intercept
+
+    def predict(self, txts: Iterable[str]) -> list[float]:
+        """returns the sentiment of each text from -1 to 1"""
+        pos = 1 / (1 + np.exp(-(self.vectorizer.transform(txts) @ self.coef + self.intercept)))
+        return np.where(pos > 1 - pos, pos, pos - 1).tolist()
+
+    def save(self, direc: str) -> None:
+        """saves the weights and vectorizer settings, no pickles so any sklearn version loads them"""
+        os.makedirs(direc, exist_ok=True)
+        np.savez_compressed(os.path.join(direc, FAST_WEIGHTS), coef=self.coef,
+                            intercept=self.intercept)
+        params = self.vectorizer.get_params()
+        with open(os.path.join(direc, FAST_CONFIG), 'w') as f:
+            json.dump({'n_features': params['n_features'], 'ngram_range': params['ngram_range'],
+                       'alternate_sign': params['alternate_sign'], 'norm': params['norm']}, f)
+
+    @classmethod
+    def load(cls, direc: str) -> 'FastSentimentModel':
+        """loads a model written by save"""
+        with open(os.path.join(direc, FAST_CONFIG)) as f:
+            params = json.load(f)
+        params['ngram_range'] = tuple(params['ngram_range'])
+        with np.load(os.path.join(direc, FAST_WEIGHTS)) as weights:
+            return cls(HashingVectorizer(**params), weights['coef'], float(weights['intercept']))
+
+
 def model_predict_sentiment(model, txt: str) -> float:
     """
     use for larger data because model is not loaded each time
@@ -31,7 +111,163 @@ def model_predict_sentiment(model, txt: str) -> float:
     Aproaching -1 being a negative sentiment
     Aproaching 1 being a positive sentiment
     """
-    vals = model(txt).cats
+    if isinstance(model, FastSentimentModel):
+        return model.predict([txt])[0]
+    return cats_to_sentiment(model(txt).cats)
+
+
+def model_predict_sentiments(model, txts: Iterable[str], batch_size: int = BATCH_SIZE,
+                             n_process: int = N_PROCESS, policy: str = LENGTH_POLICY,
+                             max_batch_tokens: int = MAX_BATCH_TOKENS) -> list[float]:
+    """
+    batched version of model_predict_sentiment, use for whole files of comments
+    texts are tokenized, sorted by token length and run through the textcat in batches
+    of at most batch_size docs and max_batch_tokens tokens, optionally spread over
+    n_process forked processes (-1 for all cores)
+    every pipe other than the textcat is skipped since only cats are needed
+    policy decides what happens to long texts, see parse_length_policy
+    returns a list of values from -1 to 1 in the same order as txts,
+    with the 'none' policy identical to calling model_predict_sentiment on each text
+    a FastSentimentModel is vectorized FAST_BATCH_SIZE texts at a time in this process,
+    its cost is linear in the text length so it ignores batch_size and the policy
+    txts may also be Docs already made by model.tokenizer, they aren't tokenized again
+    """
+    if isinstance(model, FastSentimentModel):
+        return [score for batch in minibatch((doc_text(txt) for txt in txts),
+                                             size=FAST_BATCH_SIZE)
+                for score in model.predict(batch)]
+    if n_process == -1:
+        n_process = os.cpu_count()
+    if n_process == 1:
+        return _score_texts(model, txts, batch_size, policy, max_batch_tokens)
+
+    # fork so the workers inherit the loaded model instead of unpickling it
+    chunks = ([list(chunk), batch_size, policy, max_batch_tokens]
+              for chunk in minibatch(txts, size=batch_size * 8))
+    with mp.get_context('fork').Pool(n_process, _init_worker, (model,)) as pool:
+        return [score for scores in pool.imap(_worker_score_texts, chunks) for score in scores]
+
+
+def parse_length_policy(policy: str) -> tuple[str, int]:
+    """
+    parses a policy for long texts into (mode, max tokens), the policies are
+        - 'none': score every text whole
+        - 'truncate:N': only score the first N tokens of a text
+        - 'chunk:N': split texts into pieces of at most N tokens, score every piece
+          and average the labels of the pieces weighted by their number of tokens
+    """
+    mode, _, max_tokens = policy.partition(':')
+    if mode == 'none':
+        return mode, 0
+    if mode not in ('truncate', 'chunk') or not max_tokens.isdigit() or int(max_tokens) < 1:
+        raise ValueError(f'unknown length policy {policy!r}')
+    return mode, int(max_tokens)
+
+
+def _score_texts(model, txts: Iterable[Union[str, Doc]], batch_size: int, policy: str,
+                 max_batch_tokens: int) -> list[float]:
+    """
+    scores txts with the textcat of model
+    long texts are cut into pieces following policy, the pieces are sorted by length
+    so similar lengths share a batch, and batched by _exact_batches
+    """
+    mode, max_tokens = parse_length_policy(policy)
+    pieces, owners, n_texts = [], [], 0
+    for doc in _tokenize(model, txts):
+        if mode == 'none' or len(doc) <= max_tokens:
+            pieces.append(doc)
+            owners.append(n_texts)
+        else:
+            starts = [0] if mode == 'truncate' else range(0, len(doc), max_tokens)
+            for start in starts:
+                pieces.append(_slice_doc(doc, start, min(start + max_tokens, len(doc))))
+                owners.append(n_texts)
+        n_texts += 1
+
+    textcat = model.get_pipe("textcat")
+    cats = [None] * len(pieces)
+    order = sorted(range(len(pieces)), key=lambda j: len(pieces[j]))
+    for batch in _exact_batches(pieces, order, batch_size, max_batch_tokens):
+        for j, doc in zip(batch, textcat.pipe([pieces[j] for j in batch], batch_size=len(batch))):
+            cats[j] = doc.cats
+
+    if mode != 'chunk':
+        return [cats_to_sentiment(vals) for vals in cats]
+    # token weighted average of the labels of each text's pieces
+    totals = [{'pos': 0.0, 'neg': 0.0, 'tokens': 0} for _ in range(n_texts)]
+    for j, owner in enumerate(owners):
+        weight = max(len(pieces[j]), 1)
+        totals[owner]['pos'] += cats[j]['pos'] * weight
+        totals[owner]['neg'] += cats[j]['neg'] * weight
+        totals[owner]['tokens'] += weight
+    return [cats_to_sentiment({'pos': total['pos'] / total['tokens'],
+                               'neg': total['neg'] / total['tokens']}) for total in totals]
+
+
+def _tokenize(model, txts: Iterable[Union[str, Doc]]) -> Iterator[Doc]:
+    """tokenizes txts with the tokenizer of model, Docs are passed through as they are"""
+    for txt in txts:
+        yield txt if isinstance(txt, Doc) else model.tokenizer(txt)
+
+
+def doc_text(txt: Union[str, Doc]) -> str:
+    """the text of txt, which may be a Doc"""
+    return txt.text if isinstance(txt, Doc) else txt
+
+
+def _slice_doc(doc: Doc, start: int, end: int) -> Doc:
+    """copies tokens start to end of doc into a new doc, keeping their NORM"""
+    piece = doc[start:end].as_doc()
+    piece.from_array([NORM], doc.to_array([NORM])[start:end])
+    return piece
+
+
+def _exact_batches(docs: list[Doc], order: list[int], batch_size: int,
+                   max_batch_tokens: int) -> Iterator[list[int]]:
+    """
+    groups the indices of docs, taken in order, into batches of at most batch_size docs
+    and max_batch_tokens tokens (a longer doc gets a batch of its own) that score the
+    same as each doc alone
+    the spacy 2 textcat embeds each distinct ORTH once per batch using the first token
+    it sees, so two docs where the same ORTH has a different NORM (the 's in let's is
+    normed to us) can't share a batch
+    """
+    batch, first_norms, tokens = [], {}, 0
+    for i in order:
+        # reversed so the first occurrence of each ORTH is the one kept
+        doc_norms = dict(reversed(docs[i].to_array([ORTH, NORM]).tolist()))
+        if batch and (len(batch) >= batch_size or tokens + len(docs[i]) > max_batch_tokens
+                      or any(first_norms.get(orth, norm) != norm
+                             for orth, norm in doc_norms.items())):
+            yield batch
+            batch, first_norms, tokens = [], {}, 0
+        batch.append(i)
+        tokens += len(docs[i])
+        for orth, norm in doc_norms.items():
+            first_norms.setdefault(orth, norm)
+    if batch:
+        yield batch
+
+
+def _init_worker(model) -> None:
+    """stores the model inherited from the parent process for _worker_score_texts"""
+    global _worker_model
+    _worker_model = model
+
+
+def _worker_score_texts(args: list) -> list[float]:
+    """
+    scores a chunk of texts in a worker process,
+    args is [txts, batch_size, policy, max_batch_tokens]
+    """
+    return _score_texts(_worker_model, *args)
+
+
+def cats_to_sentiment(vals: dict[str, float]) -> float:
+    """
+    converts the textcat output into a single value from -1 to 1
+    the stronger of the two labels wins, negative labels are negated
+    """
     return vals["pos"] if vals["pos"] > vals["neg"] else -1 * vals["neg"]
 
 
@@ -41,6 +277,7 @@ if __name__ == "__main__":
     txt = """should output same number"""
     print(model_predict_sentiment(model, txt))
     print(predict_sentiment(txt))
+    print(model_predict_sentiments(model, [txt])[0])
 
     # python-ta
     import python_ta
@@ -2,37 +2,368 @@
 from os import listdir
 from os.path import isfile, join
 import os
-import datetime
-import csv
+import time
 import multiprocessing as mp
+from typing import Any, Iterator, Optional
+import numpy as np
 import pandas as pd
+from models import covid_topic_labelling_model
 from models import sentiment_model
+from models import sentiment_cache
+from models import model_registry
+from util import columnar
+from util import dedupe
+from util.sentiment_stats import DailyStats
 
+PROCESSED_PATH = os.path.join('data', os.path.join('prediction_outputs',
+                                                   'predicted_sentiment_all_processed.csv'))
+# rows of comments read and scored at a time by stream_sentiment
+CHUNKSIZE = 10_000
+# comments less covid related than this are not scored for sentiment by predict_topic_sentiment
+COVID_THRESHOLD = 0.5
 
-def predict_sentiment(files: list[str]) -> None:
+
+class SentimentScorer:
+    """
+    Scores comments with a loaded model, through the sentiment cache if there is one
+
+    Instance Attributes:
+        - model: the loaded spacy or fast model
+        - cache: the sentiment cache, or None to always run the model
+        - fingerprint: fingerprint of the model directory, None without a cache
+        - batch_size: passed on to sentiment_model.model_predict_sentiments
+        - n_process: passed on to sentiment_model.model_predict_sentiments
+        - policy: how long comments are scored, see sentiment_model.parse_length_policy
+    """
+    model: Any
+    cache: Optional[sentiment_cache.SentimentCache]
+    fingerprint: Optional[str]
+    batch_size: int
+    n_process: int
+    policy: str
+
+    def __init__(self, model: Any, cache: Optional[sentiment_cache.SentimentCache] = None,
+                 fingerprint: Optional[str] = None, batch_size: int = sentiment_model.BATCH_SIZE,
+                 n_process: int = sentiment_model.N_PROCESS,
+                 policy: str = sentiment_model.LENGTH_POLICY) -> None:
+        sentiment_model.parse_length_policy(policy)
+        self.model = model
+        self.cache = cache
+        self.fingerprint = fingerprint
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.policy = policy
+
+    @classmethod
+    def open(cls, direc: str, cache_path: Optional[str] = sentiment_cache.CACHE_PATH,
+             batch_size: int = sentiment_model.BATCH_SIZE,
+             n_process: int = sentiment_model.N_PROCESS,
+             policy: str = sentiment_model.LENGTH_POLICY) -> 'SentimentScorer':
+        """loads the model in direc through the registry and opens the cache at cache_path"""
+        model = model_registry.REGISTRY.get(direc, sentiment_model.open_model)
+        if not cache_path:
+            return cls(model, None, None, batch_size, n_process, policy)
+        return cls(model, sentiment_cache.SentimentCache(cache_path),
+                   sentiment_cache.model_fingerprint(direc), batch_size, n_process, policy)
+
+    def score(self, comments: list) -> list[float]:
+        """
+        returns the sentiment of each comment from -1 to 1,
+        comments are strings or Docs made by the model's tokenizer
+        """
+        if self.cache is not None:
+            return sentiment_cache.cached_predict_sentiments(
+                self.model, comments, self.cache, self.fingerprint, self.batch_size,
+                self.n_process, self.policy)
+        return sentiment_model.model_predict_sentiments(self.model, comments, self.batch_size,
+                                                        self.n_process, self.policy)
+
+    def close(self) -> None:
+        """prints the cache statistics and closes the cache"""
+        if self.cache is not None:
+            print(self.cache.stats())
+            self.cache.close()
+
+
+class TopicSentimentScorer:
+    """
+    Fused topic filter and sentiment scoring: every comment is tokenized once, the
+    tokens feed the covid topic model and the sentiment model, and only comments at
+    least threshold covid related are scored for sentiment
+
+    Instance Attributes:
+        - scorer: scores the sentiment of the covid related comments
+        - topic_model: the lda model of covid_topic_labelling_model
+        - dictionary: the gensim dictionary of the lda model
+        - preprocessor: turns the tokenized comments into lda tokens
+        - threshold: covid relatedness from which a comment is scored for sentiment
+
+    Representation Invariants:
+        - 0 <= self.threshold <= 1
+    """
+    scorer: SentimentScorer
+    topic_model: Any
+    dictionary: Any
+    preprocessor: covid_topic_labelling_model.TopicPreprocessor
+    threshold: float
+
+    def __init__(self, scorer: SentimentScorer, topic_model: Any, dictionary: Any,
+                 preprocessor: Optional[covid_topic_labelling_model.TopicPreprocessor] = None,
+                 threshold: float = COVID_THRESHOLD) -> None:
+        self.scorer = scorer
+        self.topic_model = topic_model
+        self.dictionary = dictionary
+        self.preprocessor = preprocessor or covid_topic_labelling_model.get_preprocessor()
+        self.threshold = threshold
+
+    @classmethod
+    def open(cls, direc: str, topic_direc: str = 'models/covid_topic_labelling',
+             cache_path: Optional[str] = sentiment_cache.CACHE_PATH,
+             batch_size: int = sentiment_model.BATCH_SIZE,
+             n_process: int = sentiment_model.N_PROCESS,
+             policy: str = sentiment_model.LENGTH_POLICY,
+             threshold: float = COVID_THRESHOLD) -> 'TopicSentimentScorer':
+        """opens the sentiment scorer of direc and loads the topic model in topic_direc"""
+        dictionary, topic_model = model_registry.REGISTRY.get(
+            topic_direc, covid_topic_labelling_model.load_model)
+        return cls(SentimentScorer.open(direc, cache_path, batch_size, n_process, policy),
+                   topic_model, dictionary, threshold=threshold)
+
+    def score(self, comments: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        returns the covid relatedness of each comment from 0-1 and its sentiment
+        from -1 to 1, the sentiment is nan for comments below the threshold
+        """
+        model = self.scorer.model
+        if isinstance(model, sentiment_model.FastSentimentModel):
+            # the fast model doesn't tokenize, so the comments are only tokenized for the topics
+            docs = list(self.preprocessor.nlp.pipe(comments,
+                                                   batch_size=self.preprocessor.batch_size))
+        else:
+            docs = [model.tokenizer(comment) for comment in comments]
+        bows = [self.dictionary.doc2bow(tokens) for tokens in self.preprocessor.prepare_docs(docs)]
+        covid = covid_topic_labelling_model.covid_scores(bows, self.topic_model,
+                                                         len(self.dictionary))
+
+        sentiments = np.full(len(comments), np.nan)
+        related = np.flatnonzero(covid >= self.threshold)
+        if len(related):
+            sentiments[related] = self.scorer.score(
+                [comments[i] if isinstance(model, sentiment_model.FastSentimentModel) else docs[i]
+                 for i in related])
+        return covid, sentiments
+
+    def close(self) -> None:
+        """closes the sentiment scorer"""
+        self.scorer.close()
+
+
+def predict_sentiment(files: list[str], batch_size: int = sentiment_model.BATCH_SIZE,
+                      n_process: int = sentiment_model.N_PROCESS,
+                      cache_path: Optional[str] = sentiment_cache.CACHE_PATH,
+                      direc: str = 'models/sentiment/saved_models/model50',
+                      policy: str = sentiment_model.LENGTH_POLICY,
+                      dedupe_path: Optional[str] = dedupe.INDEX_PATH) -> None:
     """
     Use multiprocessing to speed up prediction process
     All files are passed in here and the model is applied.
+    Each file is scored as a whole through sentiment_model.model_predict_sentiments,
+    batch_size and n_process are passed on to the spacy pipe and policy decides
+    how long comments are scored.
+    Scores are looked up in the sentiment cache at cache_path first and only
+    new comments are scored, pass None to disable the cache.
+    Comments another file already owns are dropped first using the dedupe index
+    at dedupe_path (see util.dedupe), pass None to keep every row.
     The output is a csv file written to data/prediction_outputs
 
     Precondition:
         - files are a list of valid paths to unprocessed sentiment files.
     """
+    scorer = SentimentScorer.open(direc, cache_path, batch_size, n_process, policy)
+    deduplicator = dedupe.CommentDeduplicator(dedupe_path) if dedupe_path else None
     for file in files:
-        date_and_value = []
-        data = pd.read_csv(f'data/comments/{file}')
-        model = sentiment_model.open_model()
-        for index in range(len(data['Comments'])):
-            out = sentiment_model.model_predict_sentiment(model, data.loc[index, 'Comments'])
-            date_and_value.append([datetime.datetime.strptime(
-                data.loc[index, 'Date'].split(' ')[0], '%Y-%m-%d'), out])
-
-        # write file output
-        with open(f'data/prediction_outputs/predicted_sentiment{file.strip("comments")}',
-                  'w', encoding='UTF8', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['Date', 'Sentiment'])
-            writer.writerows(date_and_value)
+        _predict_file(scorer, file, deduplicator)
+        print(f'{file} done')
+    scorer.close()
+    if deduplicator is not None:
+        deduplicator.close()
+
+
+def _predict_file(scorer: SentimentScorer, file: str,
+                  deduplicator: Optional[dedupe.CommentDeduplicator] = None) -> DailyStats:
+    """
+    scores one comment file and writes its predicted_sentiment file,
+    the length policy used is recorded in the Policy column and the
+    dedupe.comment_key of each comment in the Key column
+    duplicate comments are dropped first when there is a deduplicator
+    returns the daily statistics of the file
+    """
+    data = pd.read_csv(f'data/comments/{file}')
+    if deduplicator is not None:
+        rows = len(data)
+        data = deduplicator.filter(data, file)
+        print(f'{file}: removed {rows - len(data)} duplicate comments of {rows}')
+    sentiments = scorer.score(data['Comments'].tolist())
+    dates = _parse_dates(data['Date'])
+
+    # write file output
+    keys = [dedupe.comment_key(date, comment)
+            for date, comment in zip(data['Date'], data['Comments'])]
+    pd.DataFrame({'Date': dates, 'Sentiment': sentiments, 'Policy': scorer.policy,
+                  'Key': keys}).to_csv(
+        f'data/prediction_outputs/predicted_sentiment{file.strip("comments")}',
+        index=False, encoding='UTF8', date_format='%Y-%m-%d %H:%M:%S')
+    daily = DailyStats()
+    daily.add(dates, sentiments)
+    return daily
+
+
+def stream_sentiment(files: list[str], chunksize: int = CHUNKSIZE,
+                     batch_size: int = sentiment_model.BATCH_SIZE,
+                     n_process: int = sentiment_model.N_PROCESS,
+                     cache_path: Optional[str] = sentiment_cache.CACHE_PATH,
+                     direc: str = 'models/sentiment/saved_models/model50',
+                     output: str = PROCESSED_PATH,
+                     policy: str = sentiment_model.LENGTH_POLICY,
+                     dedupe_path: Optional[str] = dedupe.INDEX_PATH) -> None:
+    """
+    Streaming alternative to predict_sentiment followed by process_raw_sentiment.
+    The comment files are read chunksize rows at a time, each chunk is deduplicated
+    as in predict_sentiment, scored and folded into the running DailyStats, so memory
+    only grows with the number of days and never with the number of comments.
+    The daily statistics are written to output in the format of process_raw_sentiment.
+
+    Precondition:
+        - files are a list of valid paths to unprocessed sentiment files.
+        - chunksize > 0
+    """
+    deduplicator = dedupe.CommentDeduplicator(dedupe_path) if dedupe_path else None
+    chunks = (deduplicator.filter(chunk, file) if deduplicator is not None else chunk
+              for file in files
+              for chunk in pd.read_csv(f'data/comments/{file}', chunksize=chunksize))
+    scorer = SentimentScorer.open(direc, cache_path, batch_size, n_process, policy)
+    write_daily_stats(fold_daily_stats(scorer, chunks), output, processed_table(output),
+                      policy=policy)
+    scorer.close()
+    if deduplicator is not None:
+        print(f'duplicates removed: {deduplicator.removed}')
+        deduplicator.close()
+
+
+def predict_topic_sentiment(files: list[str], threshold: float = COVID_THRESHOLD,
+                            chunksize: int = CHUNKSIZE,
+                            batch_size: int = sentiment_model.BATCH_SIZE,
+                            n_process: int = sentiment_model.N_PROCESS,
+                            cache_path: Optional[str] = sentiment_cache.CACHE_PATH,
+                            direc: str = 'models/sentiment/saved_models/model50',
+                            topic_direc: str = 'models/covid_topic_labelling',
+                            output: str = PROCESSED_PATH,
+                            policy: str = sentiment_model.LENGTH_POLICY,
+                            dedupe_path: Optional[str] = dedupe.INDEX_PATH) -> None:
+    """
+    stream_sentiment through a TopicSentimentScorer, so off topic comments never
+    go through the sentiment model and the daily statistics written to output only
+    cover comments at least threshold covid related.
+    Both scores of every comment are written to
+    data/prediction_outputs/predicted_topic_sentiment<suffix of the comment file>,
+    with a nan Sentiment for the comments below the threshold.
+
+    Precondition:
+        - files are a list of valid paths to unprocessed sentiment files.
+        - chunksize > 0
+    """
+    scorer = TopicSentimentScorer.open(direc, topic_direc, cache_path, batch_size, n_process,
+                                       policy, threshold)
+    deduplicator = dedupe.CommentDeduplicator(dedupe_path) if dedupe_path else None
+    daily = DailyStats()
+    for file in files:
+        output_file = f'data/prediction_outputs/predicted_topic_sentiment{file.strip("comments")}'
+        related = rows = 0
+        for i, chunk in enumerate(pd.read_csv(f'data/comments/{file}', chunksize=chunksize)):
+            if deduplicator is not None:
+                chunk = deduplicator.filter(chunk, file)
+            covid, sentiments = scorer.score(chunk['Comments'].tolist())
+            dates = _parse_dates(chunk['Date'])
+            pd.DataFrame({'Date': dates, 'Covid': covid, 'Sentiment': sentiments,
+                          'Policy': policy}).to_csv(
+                output_file, mode='w' if i == 0 else 'a', header=i == 0, index=False,
+                encoding='UTF8', date_format='%Y-%m-%d %H:%M:%S')
+            scored = ~np.isnan(sentiments)
+            daily.add(dates[scored], sentiments[scored])
+            related += int(scored.sum())
+            rows += len(chunk)
+        print(f'{file}: {related} of {rows} comments covid related')
+    write_daily_stats(daily, output, processed_table(output), policy=policy)
+    scorer.close()
+    if deduplicator is not None:
+        deduplicator.close()
+
+
+def stream_table_sentiment(table: str = columnar.COMMENTS_TABLE,
+                           start: Optional[pd.Timestamp] = None,
+                           end: Optional[pd.Timestamp] = None, chunksize: int = CHUNKSIZE,
+                           batch_size: int = sentiment_model.BATCH_SIZE,
+                           n_process: int = sentiment_model.N_PROCESS,
+                           cache_path: Optional[str] = sentiment_cache.CACHE_PATH,
+                           direc: str = 'models/sentiment/saved_models/model50',
+                           output: str = PROCESSED_PATH,
+                           policy: str = sentiment_model.LENGTH_POLICY) -> None:
+    """
+    stream_sentiment over the comments of a columnar table (see util.columnar)
+    with start <= Date < end, only the rows in range are read from disk
+    """
+    chunks = columnar.iter_chunks(table, chunksize, start, end, ['Date', 'Comments'])
+    scorer = SentimentScorer.open(direc, cache_path, batch_size, n_process, policy)
+    # the statistics of a date range never replace the processed table
+    whole = start is None and end is None
+    write_daily_stats(fold_daily_stats(scorer, chunks), output,
+                      processed_table(output) if whole else None, policy=policy)
+    scorer.close()
+
+
+def fold_daily_stats(scorer: SentimentScorer, chunks: Iterator[pd.DataFrame]) -> DailyStats:
+    """scores every chunk of Date/Comments rows and folds it into a DailyStats"""
+    daily = DailyStats()
+    for chunk in chunks:
+        daily.add(_parse_dates(chunk['Date']), scorer.score(chunk['Comments'].tolist()))
+    return daily
+
+
+def write_daily_stats(daily: DailyStats, output: str = PROCESSED_PATH,
+                      table: Optional[str] = None, policy: Optional[str] = None) -> None:
+    """
+    writes one row of statistics per day to output, the Sentiment column is the mean
+    the length policy of the scores is recorded in the Policy column when given
+    the same rows are written to the columnar table when one is given, see processed_table
+    """
+    frame = daily.to_frame()
+    if policy is not None:
+        frame['Policy'] = policy
+    frame.to_csv(output, index=False, encoding='UTF8', date_format='%Y-%m-%d %H:%M:%S')
+    if table is not None:
+        columnar.write_table(frame, table)
+
+
+def processed_table(output: str) -> Optional[str]:
+    """
+    the columnar table to write along with output: the processed table when output
+    is PROCESSED_PATH, None for any other output
+    the app reads the processed table before the csv, so it must only ever hold
+    the statistics of PROCESSED_PATH
+    """
+    if os.path.abspath(output) == os.path.abspath(PROCESSED_PATH):
+        return columnar.PROCESSED_TABLE
+    return None
+
+
+def _parse_dates(dates: pd.Series) -> pd.Series:
+    """
+    parses the '2021-12-07 11:42' comment timestamps into dates at midnight,
+    dates already read from a columnar table are only floored
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates.dt.floor('D')
+    return pd.to_datetime(dates.str.split(' ').str[0], format='%Y-%m-%d')
 
 
 def process_raw_sentiment(file: str = os.path.join('data',
@@ -40,20 +371,77 @@ def process_raw_sentiment(file: str = os.path.join('data',
                           'predicted_sentiment_all_raw.csv'))) -> None:
     """
     Takes in a file containing all the data of sentiments and
-    calculate the average for each day, then write the date and
-    average sentiment to a new file
+    calculate the statistics for each day (mean, count, standard deviation,
+    median and 95% confidence band), then write them to a new file
     """
-    df = pd.read_csv(file)
-    n = df.groupby(['Date']).mean()
-    n.to_csv(os.path.join('data',
-                          os.path.join('prediction_outputs',
-                          'predicted_sentiment_all_processed.csv')))
+    daily = DailyStats()
+    for chunk in pd.read_csv(file, chunksize=CHUNKSIZE):
+        daily.add(_parse_dates(chunk['Date']), chunk['Sentiment'])
+    write_daily_stats(daily, PROCESSED_PATH, processed_table(PROCESSED_PATH))
 
 
-def start_processes(ps: list[mp.Process]) -> None:
-    """Starts the Process object.
+def schedule_predictions(files: list[str], processes: Optional[int] = None,
+                         batch_size: int = sentiment_model.BATCH_SIZE,
+                         cache_path: Optional[str] = sentiment_cache.CACHE_PATH,
+                         direc: str = 'models/sentiment/saved_models/model50',
+                         output: str = PROCESSED_PATH,
+                         policy: str = sentiment_model.LENGTH_POLICY,
+                         dedupe_path: Optional[str] = dedupe.INDEX_PATH) -> dict[int, dict]:
+    """
+    Runs predict_sentiment over files on a pool of processes (all cores by default).
+    Each worker loads the model and opens the cache and dedupe index once, then is handed
+    whole files, largest first, so the big shards start early and the small ones fill the gaps.
+    Progress, per-worker throughput and an ETA based on the bytes left are printed
+    as files finish. The daily statistics of every file are merged and written to output.
+
+    Returns a mapping from each worker's pid to its number of files, comments and
+    seconds spent scoring.
+
+    Precondition:
+        - files are a list of valid paths to unprocessed sentiment files.
     """
-    for p in ps:
-        p.start()
-    for p in ps:
-        p.join()
\ No newline at end of file
+    sizes = {file: os.path.getsize(f'data/comments/{file}') for file in files}
+    total, done = sum(sizes.values()), 0
+    workers = {}
+    daily = DailyStats()
+    start = time.perf_counter()
+
+    with mp.Pool(processes, _init_worker,
+                 (direc, cache_path, batch_size, policy, dedupe_path)) as pool:
+        for pid, file, file_daily, seconds in pool.imap_unordered(
+                _worker_predict_file, sorted(files, key=sizes.get, reverse=True)):
+            daily.merge(file_daily)
+            rows = file_daily.count()
+            done += sizes[file]
+            stats = workers.setdefault(pid, {'files': 0, 'comments': 0, 'seconds': 0.0})
+            stats['files'] += 1
+            stats['comments'] += rows
+            stats['seconds'] += seconds
+            elapsed = time.perf_counter() - start
+            print(f'{file}: {rows} comments in {seconds:.1f}s on worker {pid} '
+                  f'({rows / seconds:.0f}/s), {done / total:.0%} done, '
+                  f'ETA {elapsed * (total - done) / done:.0f}s')
+
+    for pid, stats in workers.items():
+        print(f'worker {pid}: {stats["files"]} files, {stats["comments"]} comments, '
+              f'{stats["comments"] / stats["seconds"]:.0f} comments/s')
+    write_daily_stats(daily, output, processed_table(output), policy=policy)
+    return workers
+
+
+# scorer and deduplicator of a schedule_predictions worker, set by _init_worker
+_worker = {}
+
+
+def _init_worker(direc: str, cache_path: Optional[str], batch_size: int, policy: str,
+                 dedupe_path: Optional[str]) -> None:
+    """loads the model and opens the cache and dedupe index once per worker process"""
+    _worker['scorer'] = SentimentScorer.open(direc, cache_path, batch_size, 1, policy)
+    _worker['deduplicator'] = dedupe.CommentDeduplicator(dedupe_path) if dedupe_path else None
+
+
+def _worker_predict_file(file: str) -> tuple[int, str, DailyStats, float]:
+    """scores file in a worker, returns (pid, file, daily statistics of file, seconds)"""
+    start = time.perf_counter()
+    daily = _predict_file(_worker['scorer'], file, _worker['deduplicator'])
+    return os.getpid(), file, daily, time.perf_counter() - start
@@ -0,0 +1,150 @@
+"""Columnar, memory-mapped storage for comments and processed predictions
+
+A table is a directory holding one .npy file per column, with the rows sorted by
+the 'Date' column. Numeric and date columns are memory-mapped on read, so a date
+range only touches the pages it needs and comes back as zero-copy views. Text
+columns are stored as one utf-8 blob (<column>.bin) plus row offsets
+(<column>.offsets.npy) and only the rows in range are decoded.
+
+    data/columnar/comments/        Date, Comments
+    data/columnar/processed/       Date, Sentiment, Count, Std, ...
+"""
+import glob
+import json
+import os
+from typing import Iterator, Optional
+import numpy as np
+import pandas as pd
+
+COLUMNAR_PATH = os.path.join('data', 'columnar')
+COMMENTS_TABLE = os.path.join(COLUMNAR_PATH, 'comments')
+PROCESSED_TABLE = os.path.join(COLUMNAR_PATH, 'processed')
+_META = 'meta.json'
+
+
+def write_table(data: pd.DataFrame, path: str) -> None:
+    """
+    Writes data to the table directory path, sorted by date.
+    Non-numeric columns are stored as text, every other column as a .npy array.
+
+    Precondition:
+        - 'Date' in data.columns
+    """
+    os.makedirs(path, exist_ok=True)
+    data = data.assign(Date=pd.to_datetime(data['Date'])).sort_values('Date', kind='stable')
+    text_columns = []
+    for column in data.columns:
+        if column == 'Date':
+            np.save(os.path.join(path, 'Date.npy'), data[column].values.astype('datetime64[ns]'))
+        elif not pd.api.types.is_numeric_dtype(data[column]):
+            text_columns.append(column)
+            encoded = [str(value).encode('utf-8') for value in data[column].fillna('')]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(value) for value in encoded], out=offsets[1:])
+            np.save(os.path.join(path, f'{column}.offsets.npy'), offsets)
+            with open(os.path.join(path, f'{column}.bin'), 'wb') as f:
+                f.write(b''.join(encoded))
+        else:
+            np.save(os.path.join(path, f'{column}.npy'), data[column].values)
+
+    with open(os.path.join(path, _META), 'w') as f:
+        json.dump({'columns': list(data.columns), 'text': text_columns, 'rows': len(data)}, f)
+
+
+def read_columns(path: str, start: Optional[pd.Timestamp] = None,
+                 end: Optional[pd.Timestamp] = None,
+                 columns: Optional[list[str]] = None) -> dict[str, np.ndarray]:
+    """
+    Returns the columns of the table at path for the rows with start <= Date < end.
+    Numeric and date columns are read-only views into memory-mapped files,
+    text columns are decoded into object arrays.
+    A missing start or end leaves that side of the range open.
+    """
+    meta = _read_meta(path)
+    lo, hi = date_range_rows(path, start, end)
+    out = {}
+    for column in columns or meta['columns']:
+        if column in meta['text']:
+            out[column] = _read_text(path, column, lo, hi)
+        else:
+            out[column] = np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r')[lo:hi]
+    return out
+
+
+def read_table(path: str, start: Optional[pd.Timestamp] = None,
+               end: Optional[pd.Timestamp] = None,
+               columns: Optional[list[str]] = None) -> pd.DataFrame:
+    """read_columns as a DataFrame, pandas copies the column views into its own blocks"""
+    return pd.DataFrame(read_columns(path, start, end, columns))
+
+
+def iter_chunks(path: str, chunksize: int, start: Optional[pd.Timestamp] = None,
+                end: Optional[pd.Timestamp] = None,
+                columns: Optional[list[str]] = None) -> Iterator[pd.DataFrame]:
+    """yields the rows of read_table chunksize rows at a time, decoding one chunk at a time"""
+    meta = _read_meta(path)
+    lo, hi = date_range_rows(path, start, end)
+    columns = columns or meta['columns']
+    arrays = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r')
+              for column in columns if column not in meta['text']}
+    for i in range(lo, hi, chunksize):
+        j = min(i + chunksize, hi)
+        yield pd.DataFrame({column: _read_text(path, column, i, j) if column in meta['text']
+                            else arrays[column][i:j] for column in columns})
+
+
+def date_range_rows(path: str, start: Optional[pd.Timestamp] = None,
+                    end: Optional[pd.Timestamp] = None) -> tuple[int, int]:
+    """
+    returns the row range [lo, hi) of the rows with start <= Date < end,
+    found by binary search on the sorted, memory-mapped Date column
+    """
+    dates = np.load(os.path.join(path, 'Date.npy'), mmap_mode='r')
+    lo = 0 if start is None else int(np.searchsorted(dates, np.datetime64(start, 'ns')))
+    hi = len(dates) if end is None else int(np.searchsorted(dates, np.datetime64(end, 'ns')))
+    return lo, max(lo, hi)
+
+
+def table_exists(path: str) -> bool:
+    """returns whether path holds a table written by write_table"""
+    return os.path.isfile(os.path.join(path, _META))
+
+
+def convert_csvs(comments_pattern: str = os.path.join('data', 'comments', 'comments*.csv'),
+                 predictions_pattern: str = os.path.join('data', 'prediction_outputs',
+                                                         'predicted_sentiment*.csv')) -> None:
+    """
+    One-time conversion of the existing csv files into the comments and processed
+    tables. Only the processed file of the files matching predictions_pattern is
+    converted, the raw prediction shards are only read while processing and are kept
+    as csv files.
+    """
+    comment_files = sorted(glob.glob(comments_pattern))
+    write_table(pd.concat([pd.read_csv(file) for file in comment_files], ignore_index=True),
+                COMMENTS_TABLE)
+
+    processed = [file for file in glob.glob(predictions_pattern) if file.endswith('_processed.csv')]
+    for file in processed:
+        write_table(pd.read_csv(file), PROCESSED_TABLE)
+
+
+def _read_meta(path: str) -> dict:
+    """reads the column names and text columns of the table at path"""
+    with open(os.path.join(path, _META)) as f:
+        return json.load(f)
+
+
+def _read_text(path: str, column: str, lo: int, hi: int) -> np.ndarray:
+    """decodes rows lo to hi of a text column"""
+    offsets = np.load(os.path.join(path, f'{column}.offsets.npy'), mmap_mode='r')[lo:hi + 1]
+    out = np.empty(hi - lo, dtype=object)
+    if hi == lo:
+        return out
+    blob_path = os.path.join(path, f'{column}.bin')
+    if os.path.getsize(blob_path) == 0:
+        out[:] = ''
+        return out
+    blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+    for i in range(hi - lo):
+        out[i] = blob[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+    return out
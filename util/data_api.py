@@ -0,0 +1,166 @@
+"""JSON and binary range queries over the data sets of the app
+
+    GET /api/series                     the series, their columns, date ranges and versions
+    GET /api/series/<name>?start=&end=  rows of a series with start <= Date < end
+
+Series are 'cases', 'sentiment' and 'daily' (see data_loading.get_data), of the
+default region or of another one with region= (see data_loading.region_data_sets).
+Rows are found by binary search on the sorted dates and served column by column,
+as compact json by default or as an .npz archive of numpy arrays with format=npz.
+Every response has an ETag and Last-Modified derived from the version of the data,
+so pollers sending If-None-Match or If-Modified-Since get an empty 304 while the
+data hasn't changed.
+"""
+import datetime
+import hashlib
+import io
+import os
+from typing import Optional
+import flask
+import numpy as np
+import pandas as pd
+from util import data_loading
+
+API_ROUTE = '/api/series'
+# name of each series in the api and its key in data_sets
+SERIES = {'cases': 'case data', 'sentiment': 'sentiment data', 'daily': 'daily data'}
+FORMATS = ('json', 'npz')
+
+
+def install(server: flask.Flask, data_sets: dict[str, pd.DataFrame]) -> None:
+    """serves the series of data_sets at API_ROUTE on server"""
+    region = data_sets.get('region')
+    versions = {(name, region): data_version(data_sets[key]) for name, key in SERIES.items()}
+    sources = data_loading.source_files()
+    last_modified = datetime.datetime.fromtimestamp(
+        max((os.path.getmtime(file) for file in sources), default=0), datetime.timezone.utc
+    ).replace(microsecond=0)
+
+    @server.route(API_ROUTE)
+    def list_series() -> flask.Response:
+        return flask.jsonify({name: {'columns': list(data_sets[key].columns),
+                                     'start': _day(data_sets[key]['Date'].iloc[0]),
+                                     'end': _day(data_sets[key]['Date'].iloc[-1]),
+                                     'rows': len(data_sets[key]),
+                                     'version': versions[(name, region)]}
+                              for name, key in SERIES.items()})
+
+    @server.route(f'{API_ROUTE}/<name>')
+    def get_series(name: str) -> flask.Response:
+        if name not in SERIES:
+            return _error(404, f'unknown series {name!r}, expected one of {list(SERIES)}')
+        args = flask.request.args
+        data_format = args.get('format', 'json')
+        if data_format not in FORMATS:
+            return _error(400, f'unknown format {data_format!r}, expected one of {FORMATS}')
+        try:
+            start, end = _parse_day(args.get('start')), _parse_day(args.get('end'))
+        except ValueError as error:
+            return _error(400, str(error))
+        columns = args.get('columns')
+        columns = columns.split(',') if columns else None
+        try:
+            region_sets = data_loading.region_data_sets(data_sets, args.get('region'))
+        except KeyError:
+            return _error(404, f'unknown region {args.get("region")!r}')
+        data = region_sets[SERIES[name]]
+        key = (name, region_sets.get('region'))
+        if key not in versions:
+            versions[key] = data_version(data)
+        if columns is not None and not set(columns) <= set(data.columns):
+            return _error(400, f'unknown columns {sorted(set(columns) - set(data.columns))}')
+
+        etag = hashlib.sha1(repr((versions[key], start, end, columns, data_format))
+                            .encode('utf-8')).hexdigest()
+        if _not_modified(etag, last_modified):
+            response = flask.Response(status=304)
+        else:
+            rows = data.iloc[slice(*query_rows(data, start, end))]
+            if columns is not None:
+                rows = rows[['Date'] + [column for column in columns if column != 'Date']]
+            response = encode_npz(rows) if data_format == 'npz' else encode_json(rows)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+
+
+def data_version(data: pd.DataFrame) -> str:
+    """hex sha1 of the contents of data, it changes whenever the data does"""
+    digest = hashlib.sha1(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    digest.update(repr(list(data.columns)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def query_rows(data: pd.DataFrame, start: Optional[datetime.datetime],
+               end: Optional[datetime.datetime]) -> tuple[int, int]:
+    """
+    returns the row range [lo, hi) of the rows with start <= Date < end, found by binary
+    search, a missing start or end leaves that side of the range open
+
+    Precondition:
+        - data is sorted by Date (see data_loading.sort_by_date)
+    """
+    dates = data['Date']
+    lo = 0 if start is None else int(dates.searchsorted(start, side='left'))
+    hi = len(dates) if end is None else int(dates.searchsorted(end, side='left'))
+    return lo, max(lo, hi)
+
+
+def encode_json(rows: pd.DataFrame) -> flask.Response:
+    """rows as {'Date': ['YYYY-MM-DD', ...], <column>: [...], ...}"""
+    columns = {column: _day_strings(rows[column]) if column == 'Date'
+               else rows[column].where(rows[column].notna(), None).tolist()
+               for column in rows.columns}
+    return flask.jsonify(columns)
+
+
+def encode_npz(rows: pd.DataFrame) -> flask.Response:
+    """rows as an .npz archive with one array per column, readable without pickle"""
+    arrays = {}
+    for column in rows.columns:
+        values = rows[column].values
+        if column == 'Date':
+            arrays[column] = values.astype('datetime64[D]')
+        elif values.dtype == object:
+            arrays[column] = values.astype(str)
+        else:
+            arrays[column] = values
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return flask.Response(buffer.getvalue(), mimetype='application/octet-stream')
+
+
+def _not_modified(etag: str, last_modified: datetime.datetime) -> bool:
+    """whether the request's conditional headers say its copy is still current"""
+    request = flask.request
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return request.if_modified_since is not None and request.if_modified_since >= last_modified
+
+
+def _parse_day(day: Optional[str]) -> Optional[datetime.datetime]:
+    """parses a 'YYYY-MM-DD' query argument"""
+    if not day:
+        return None
+    try:
+        return datetime.datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'dates must be YYYY-MM-DD, got {day!r}') from None
+
+
+def _day(date: pd.Timestamp) -> str:
+    """date as 'YYYY-MM-DD'"""
+    return date.strftime('%Y-%m-%d')
+
+
+def _day_strings(dates: pd.Series) -> list[str]:
+    """dates as 'YYYY-MM-DD' strings"""
+    return dates.dt.strftime('%Y-%m-%d').tolist()
+
+
+def _error(status: int, message: str) -> flask.Response:
+    """a json error response"""
+    response = flask.jsonify({'error': message})
+    response.status_code = status
+    return response
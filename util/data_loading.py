@@ -1,13 +1,29 @@
 """Utility functions for loading the data"""
 import os
 import datetime
+import functools
+import glob
+import hashlib
+import pickle
+import time
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import dash_bootstrap_components as dbc
+from util import columnar
+from util import regions
 
 # Data Loading
 
 PARENT_PATH = Path(os.path.dirname(os.path.realpath(__file__))).parent.absolute()
+# cleaned data sets of get_data, rebuilt when a source file changes
+SNAPSHOT_PATH = os.path.join(PARENT_PATH, os.path.join('data', 'app_snapshot.pkl'))
+# bumped whenever get_data changes what it returns, so older snapshots are rebuilt
+SNAPSHOT_VERSION = 5
+# case data of every region, partitioned by util.regions
+REGIONS_PATH = os.path.join(PARENT_PATH, regions.CASES_TABLE)
+# largest lag in days between new cases and sentiment with precomputed products
+MAX_LAG = 60
 
 
 def read_style_sheet() -> list[str]:
@@ -51,9 +67,13 @@ def read_case_data() -> pd.DataFrame:
 def read_sentiment_data() -> pd.DataFrame:
     """Convert the sentiment file into a DataFrame object
 
-    Returns a DataFrame of predicted_sentiment_all_processed.csv'
+    Reads the columnar processed table when it exists (see util.columnar),
+    otherwise returns a DataFrame of predicted_sentiment_all_processed.csv'
     Returns None if paths are not valid
     """
+    table = os.path.join(PARENT_PATH, columnar.PROCESSED_TABLE)
+    if columnar.table_exists(table):
+        return columnar.read_table(table)
     try:
         return pd.read_csv(os.path.join(PARENT_PATH,
                            os.path.join('data',
@@ -63,6 +83,20 @@ def read_sentiment_data() -> pd.DataFrame:
         return None
 
 
+def read_comment_data(start: datetime.datetime = None,
+                      end: datetime.datetime = None) -> pd.DataFrame:
+    """Reads the comments with start <= Date < end from the columnar comments table.
+    Only the rows in the range are read from disk.
+
+    Returns a DataFrame with the columns Date and Comments
+    Returns None if the table has not been converted with util.columnar.convert_csvs
+    """
+    table = os.path.join(PARENT_PATH, columnar.COMMENTS_TABLE)
+    if not columnar.table_exists(table):
+        return None
+    return columnar.read_table(table, start, end)
+
+
 def clean_case_data(data: pd.DataFrame) -> None:
     """Cleans the data of the DataFrame of covid_cases.csv
     so that it is usable by plotly express.
@@ -73,8 +107,7 @@ def clean_case_data(data: pd.DataFrame) -> None:
 
     The Dictionary is mutated and not returned.
     """
-    for day in range(len(data['Date'])):
-        data.loc[day, 'Date'] = datetime.datetime.strptime(data.loc[day, 'Date'], '%b %d %Y')
+    data['Date'] = pd.to_datetime(data['Date'], format='%b %d %Y')
 
 
 def clean_sentiment_data(data: pd.DataFrame) -> None:
@@ -86,26 +119,208 @@ def clean_sentiment_data(data: pd.DataFrame) -> None:
         - Dates are in the format '2020-02-10 00:00:00'
 
     The Dictionary is mutated and not returned.
+    Dates read from a columnar table are already parsed and left as is.
+    """
+    if pd.api.types.is_datetime64_any_dtype(data['Date']):
+        return
+    data['Date'] = pd.to_datetime(data['Date'].str.split(' ').str[0], format='%Y-%m-%d')
+
+
+def sort_by_date(data: pd.DataFrame) -> pd.DataFrame:
+    """Returns data sorted by its cleaned Date column with a fresh index,
+    so a date range can be found by binary search (see graph_updater.date_slice).
+
+    Precondition:
+        - 'Date' in data.columns
     """
-    for day in range(len(data['Date'])):
-        data.loc[day, 'Date'] = datetime.datetime.strptime(
-            data.loc[day, 'Date'].split(' ')[0], '%Y-%m-%d')
+    return data.sort_values('Date', kind='stable', ignore_index=True)
 
 
-def get_data() -> dict[str: pd.DataFrame]:
+def daily_series(case_data: pd.DataFrame, sentiment_data: pd.DataFrame) -> pd.DataFrame:
+    """Returns New Cases and Sentiment on every day both data sets cover, sentiment on
+    days without comments is interpolated from the days around them.
+    For both series the cumulative sums ('<column> Sum') and sums of squares
+    ('<column> Sum Sq') up to and including each day are added, so the sum over any
+    run of days is the difference of two entries (see graph_updater.rolling_stat).
+
+    Preconditions:
+        - case_data and sentiment_data are cleaned and sorted by date
+    """
+    start = max(case_data['Date'].iloc[0], sentiment_data['Date'].iloc[0])
+    end = min(case_data['Date'].iloc[-1], sentiment_data['Date'].iloc[-1])
+    days = pd.date_range(start, end, freq='D')
+    daily = pd.DataFrame({
+        'Date': days,
+        'New Cases': case_data.set_index('Date')['New Cases'].reindex(days)
+                              .interpolate('time').values.astype(float),
+        'Sentiment': sentiment_data.set_index('Date')['Sentiment']
+                                   .reindex(days.union(sentiment_data['Date']))
+                                   .interpolate('time').reindex(days).values,
+    })
+    for column in ('New Cases', 'Sentiment'):
+        daily[f'{column} Sum'] = daily[column].cumsum()
+        daily[f'{column} Sum Sq'] = (daily[column] ** 2).cumsum()
+    return daily
+
+
+def lag_sums(daily: pd.DataFrame, max_lag: int = MAX_LAG) -> pd.DataFrame:
+    """Returns the cumulative sums of New Cases on each day times Sentiment lag days later,
+    in the column 'Lag <lag>' for every lag from -max_lag to max_lag.
+    Products whose later day is past the end of daily count as 0.
+    Row i of a column is the sum over the days up to and including row i of daily.
+
+    Preconditions:
+        - daily was made by daily_series
+    """
+    cases, sentiment = daily['New Cases'].values, daily['Sentiment'].values
+    n = len(daily)
+    sums = {}
+    for lag in range(-max_lag, max_lag + 1):
+        products = np.zeros(n)
+        if abs(lag) < n:
+            lo, hi = max(0, -lag), min(n, n - lag)
+            products[lo:hi] = cases[lo:hi] * sentiment[lo + lag:hi + lag]
+        sums[f'Lag {lag}'] = np.cumsum(products)
+    return pd.DataFrame(sums)
+
+
+def get_data(snapshot: bool = True) -> dict[str: pd.DataFrame]:
     """Gets all the data sets required by the app and returns them in a dictionary.
-    The dictionary includes three key-value pairs:
+    The dictionary includes seven key-value pairs:
     1. Mapping from the name of the file to the DataFrame of dates vs. new cases
     2. Mapping from the name of the file to the DataFrame of dates vs. public sentiment
     3. Mapping from the name of the file to the DataFrame of iterations vs. model loss
+    4. Mapping from 'daily data' to the prefix sums of daily_series
+    5. Mapping from 'lag sums' to the prefix sums of lag_sums
+    6. Mapping from 'region' to the region of the case data, regions.DEFAULT_REGION
+    7. Mapping from 'case regions' to a regions.CaseStore of the data sets of every
+       region, see region_data_sets
+
+    The case and sentiment data are sorted by date.
+    The cleaned data sets are loaded from the snapshot at SNAPSHOT_PATH while none
+    of the source files changed, otherwise they are read, cleaned and snapshotted again
+    and the case data is partitioned by region into REGIONS_PATH.
+    Only the default region is in the snapshot, other regions are read when they are used.
+    Pass snapshot=False to always read the source files.
     """
+    start = time.perf_counter()
+    if snapshot:
+        data_sets = load_snapshot()
+        if data_sets is not None and regions.partitions_exist(REGIONS_PATH):
+            print(f'data loaded from snapshot in {time.perf_counter() - start:.3f}s')
+            return _with_regions(data_sets)
+
     model_data = read_model_data()
     case_data = read_case_data()
     sentiment_data = read_sentiment_data()
     clean_case_data(case_data)
     clean_sentiment_data(sentiment_data)
-    return {
+    regions.write_partitions(case_data, REGIONS_PATH)
+    # like the partitions of every region, the case data has no State column
+    case_data = sort_by_date(case_data[case_data['State'] == regions.DEFAULT_REGION]
+                             .drop(columns='State'))
+    sentiment_data = sort_by_date(sentiment_data)
+    daily_data = daily_series(case_data, sentiment_data)
+    data_sets = {
         'model data': model_data,
         'case data': case_data,
-        'sentiment data': sentiment_data
-    }
\ No newline at end of file
+        'sentiment data': sentiment_data,
+        'daily data': daily_data,
+        'lag sums': lag_sums(daily_data)
+    }
+    if snapshot:
+        try:
+            save_snapshot(data_sets)
+        except OSError as error:
+            print(f'could not write the data snapshot: {error}')
+    print(f'data loaded from source files in {time.perf_counter() - start:.3f}s')
+    return _with_regions(data_sets)
+
+
+def region_data_sets(data_sets: dict[str: pd.DataFrame], region: str) -> dict[str: pd.DataFrame]:
+    """Returns data_sets with the case data of region and the daily series made from it.
+    The data sets of the last regions.RESIDENT_REGIONS regions are kept in memory,
+    so the same dictionary is returned while region stays resident.
+
+    Raises KeyError when there is no such region
+    """
+    if region is None or region == data_sets.get('region') or 'case regions' not in data_sets:
+        return data_sets
+    return data_sets['case regions'].get(region)
+
+
+def _with_regions(data_sets: dict[str: pd.DataFrame]) -> dict[str: pd.DataFrame]:
+    """Adds the default region and the store of every region to data_sets.
+    The store is made when the data is loaded, it is not part of the snapshot.
+    """
+    data_sets['region'] = regions.DEFAULT_REGION
+    data_sets['case regions'] = regions.CaseStore(
+        REGIONS_PATH, derive=functools.partial(_derive_region, data_sets))
+    return data_sets
+
+
+def _derive_region(data_sets: dict[str: pd.DataFrame], region: str,
+                   case_data: pd.DataFrame) -> dict[str: pd.DataFrame]:
+    """the data sets of region, whose case data is case_data"""
+    daily_data = daily_series(case_data, data_sets['sentiment data'])
+    return {**data_sets, 'region': region, 'case data': case_data, 'daily data': daily_data,
+            'lag sums': lag_sums(daily_data)}
+
+
+def source_files() -> list[str]:
+    """Returns the paths of every file get_data reads that exists,
+    including every file of the columnar processed table when it exists.
+    """
+    paths = [os.path.join(PARENT_PATH, os.path.join('data', 'evaluations.csv')),
+             os.path.join(PARENT_PATH, os.path.join('data', 'covid_cases.csv')),
+             os.path.join(PARENT_PATH, os.path.join('data', os.path.join(
+                 'prediction_outputs', 'predicted_sentiment_all_processed.csv')))]
+    paths.extend(sorted(glob.glob(os.path.join(PARENT_PATH, columnar.PROCESSED_TABLE, '*'))))
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def load_snapshot(path: str = SNAPSHOT_PATH) -> dict[str: pd.DataFrame]:
+    """Returns the data sets of the snapshot at path.
+    The snapshot is valid while the source files are the same files as when it was taken.
+    Files whose mtime and size are unchanged are trusted, the others are only hashed
+    when their size still matches, so touching a file doesn't invalidate the snapshot.
+
+    Returns None if there is no valid snapshot
+    """
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION \
+            or sorted(snapshot['sources']) != sorted(source_files()):
+        return None
+    for file, (mtime, size, digest) in snapshot['sources'].items():
+        stat = os.stat(file)
+        if (stat.st_mtime_ns, stat.st_size) == (mtime, size):
+            continue
+        if stat.st_size != size or _file_digest(file) != digest:
+            return None
+    return snapshot['data sets']
+
+
+def save_snapshot(data_sets: dict[str: pd.DataFrame], path: str = SNAPSHOT_PATH) -> None:
+    """Writes the cleaned data sets and the mtime, size and sha1 of their sources to path"""
+    sources = {}
+    for file in source_files():
+        stat = os.stat(file)
+        sources[file] = (stat.st_mtime_ns, stat.st_size, _file_digest(file))
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        pickle.dump({'version': SNAPSHOT_VERSION, 'sources': sources, 'data sets': data_sets},
+                    f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+
+def _file_digest(path: str) -> str:
+    """Returns the hex sha1 of the contents of the file at path"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,152 @@
+"""Deduplication of comments across the overlapping files in data/comments
+
+The undated comments.csv...comments4.csv and the dated shards cover the same
+periods, so the same comment can be scored and counted several times. A comment
+is identified by its timestamp and its text with whitespace and case folded.
+A persistent index remembers which file owns each comment: the first file to
+see it keeps it, every other file drops it, so re-runs keep the same rows.
+
+Near duplicates (the same comment with small edits) can also be dropped with
+MinHash signatures over word 3-grams and locality sensitive hashing. These are
+only compared within one CommentDeduplicator, so use a single process for them.
+"""
+import hashlib
+import os
+import sqlite3
+import zlib
+from typing import Optional
+import numpy as np
+import pandas as pd
+from util import sqlite_util
+
+INDEX_PATH = os.path.join('data', 'dedupe_index.sqlite3')
+# Mersenne prime for the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+class CommentDeduplicator:
+    """
+    Filters duplicate comments out of the comment files
+
+    Instance Attributes:
+        - path: location of the sqlite fingerprint index, ':memory:' for a throwaway one
+        - near_threshold: estimated Jaccard similarity from which a comment is a near
+          duplicate of an earlier one, None to only drop exact duplicates
+        - removed: number of rows dropped from each file, exact and near duplicates
+
+    Representation Invariants:
+        - self.near_threshold is None or 0 < self.near_threshold <= 1
+    """
+    path: str
+    near_threshold: Optional[float]
+    removed: dict[str, dict[str, int]]
+
+    def __init__(self, path: str = INDEX_PATH, near_threshold: Optional[float] = None,
+                 num_perm: int = 64, bands: int = 16, seed: int = 0) -> None:
+        self.path = path
+        self.near_threshold = near_threshold
+        self.removed = {}
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS owners '
+                           '(key TEXT PRIMARY KEY, file TEXT NOT NULL)')
+        self._conn.commit()
+
+        rng = np.random.RandomState(seed)
+        self._perm_a = rng.randint(1, 1 << 31, num_perm).astype(np.uint64)
+        self._perm_b = rng.randint(0, 1 << 31, num_perm).astype(np.uint64)
+        self._bands = bands
+        self._buckets = {}
+        self._signatures = []
+        # keys already kept from the file being filtered, for files read in chunks
+        self._file = None
+        self._file_keys = set()
+
+    def filter(self, data: pd.DataFrame, file: str) -> pd.DataFrame:
+        """
+        returns the rows of data from file that are not duplicates,
+        adding the counts of dropped rows to self.removed[file]
+
+        Precondition:
+            - 'Date' in data.columns and 'Comments' in data.columns
+        """
+        keys = [comment_key(date, comment)
+                for date, comment in zip(data['Date'], data['Comments'])]
+        unique_keys = list(dict.fromkeys(keys))
+        self._conn.executemany('INSERT OR IGNORE INTO owners VALUES (?, ?)',
+                               [(key, file) for key in unique_keys])
+        self._conn.commit()
+        owners = dict(sqlite_util.select_in(
+            self._conn, 'SELECT key, file FROM owners WHERE key IN ({})', unique_keys))
+
+        if file != self._file:
+            self._file, self._file_keys = file, set()
+        keep = np.zeros(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            if owners[key] == file and key not in self._file_keys:
+                keep[i] = True
+                self._file_keys.add(key)
+        counts = self.removed.setdefault(file, {'exact': 0, 'near': 0})
+        counts['exact'] += int(len(keep) - keep.sum())
+
+        if self.near_threshold is not None:
+            for i in np.flatnonzero(keep):
+                if self._is_near_duplicate(str(data['Comments'].iloc[i])):
+                    keep[i] = False
+                    counts['near'] += 1
+        return data[keep]
+
+    def close(self) -> None:
+        """closes the connection to the index"""
+        self._conn.close()
+
+    def _is_near_duplicate(self, comment: str) -> bool:
+        """
+        checks comment against the signatures of earlier comments sharing an LSH band,
+        records its signature when it is not a near duplicate
+        """
+        signature = self._signature(comment)
+        rows = len(signature) // self._bands
+        bands = [(b, signature[b * rows:(b + 1) * rows].tobytes()) for b in range(self._bands)]
+        candidates = {i for band in bands for i in self._buckets.get(band, ())}
+        if any(np.mean(self._signatures[i] == signature) >= self.near_threshold
+               for i in candidates):
+            return True
+        for band in bands:
+            self._buckets.setdefault(band, []).append(len(self._signatures))
+        self._signatures.append(signature)
+        return False
+
+    def _signature(self, comment: str) -> np.ndarray:
+        """MinHash signature of the word 3-grams of comment"""
+        words = comment.lower().split()
+        shingles = {' '.join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles],
+                          dtype=np.uint64)
+        return ((np.outer(hashes, self._perm_a) + self._perm_b) % _PRIME).min(axis=0)
+
+
+def comment_key(date: str, comment: str) -> str:
+    """hex sha1 of the comment's timestamp and its text with whitespace and case folded"""
+    text = ' '.join(str(comment).split()).lower()
+    return hashlib.sha1(f'{date}\x00{text}'.encode('utf-8')).hexdigest()
+
+
+def dedupe_files(files: list[str], direc: str = 'data/comments',
+                 output_direc: Optional[str] = None, index_path: str = INDEX_PATH,
+                 near_threshold: Optional[float] = None) -> dict[str, dict[str, int]]:
+    """
+    Runs the deduplication over files in direc as a stage of its own,
+    writing the kept rows to output_direc (nothing is written without one).
+    Prints and returns the number of rows removed from each file.
+    """
+    deduplicator = CommentDeduplicator(index_path, near_threshold)
+    for file in files:
+        data = pd.read_csv(f'{direc}/{file}')
+        kept = deduplicator.filter(data, file)
+        print(f'{file}: removed {len(data) - len(kept)} of {len(data)} rows '
+              f'{deduplicator.removed[file]}')
+        if output_direc is not None:
+            os.makedirs(output_direc, exist_ok=True)
+            kept.to_csv(f'{output_direc}/{file}', index=False, encoding='UTF8')
+    deduplicator.close()
+    return deduplicator.removed
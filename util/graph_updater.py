@@ -1,14 +1,41 @@
 """Utility functions from updaing the graph"""
 
+import functools
+import threading
+from collections import OrderedDict
+import numpy as np
 import plotly.express as px
 import plotly.io as pio
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
 import pandas as pd
 from dash import dcc
+try:
+    from dash import Patch
+except ImportError:
+    # dash before 2.9 has no partial updates, whole figures are sent instead
+    Patch = None
 import datetime
+from typing import Any, Optional
+from util import metrics
 
 pio.templates.default = "simple_white"
 
+# number of (region, start date, end date, moving average, historic) figure pairs kept built
+FIGURE_CACHE_SIZE = 128
+_figures = OrderedDict()
+_figures_lock = threading.Lock()
+# how long ranges are thinned out before they are plotted, see downsample_indices
+DOWNSAMPLE = 'lttb'
+# most points sent to the browser per trace
+POINT_BUDGET = 1000
+# traces over ranges of more rows are drawn with WebGL instead of SVG, see fill_figure
+WEBGL_POINTS = 1000
+# the column of each trace of the case and sentiment figures and the toggle showing it
+CASE_TRACES = (('New Cases', None), ('7-Day Moving Avg', 'moving_av'),
+               ('Historic Cases', 'historic'))
+SENTIMENT_TRACES = (('Sentiment', None),)
+
 def update_main_graph(data_sets: dict[str, pd.DataFrame]) -> px.line:
     """Output a main graph of ML post training. This graph is not updated.
 
@@ -28,47 +55,329 @@ def update_main_graph(data_sets: dict[str, pd.DataFrame]) -> px.line:
 
 
 def generate_graph(data_sets: dict[str, pd.DataFrame], start_date: datetime.datetime, 
-                   end_date: datetime.datetime, moving_av: bool, historic: bool) -> tuple[px.line, px.line]:
+                   end_date: datetime.datetime, moving_av: bool, historic: bool,
+                   downsample: Optional[str] = DOWNSAMPLE,
+                   budget: int = POINT_BUDGET) -> tuple[dict, dict]:
     """Takes in the inputs and returns two graph object. The inputs are the data sets, start date,
     end date, moving average, and hisotric data.
     
     Preconditions:
         - start_date and end_date are within the range of dates in each data set in data_sets
 
-    Returns two plot.express.line graphs, the first one containing new cases vs. date,
-    the second one containing sentiment vs. date.
+    Returns two line figures as plotly json dicts, the first one containing new cases vs. date,
+    the second one containing sentiment vs. date. They are filled into prebuilt
+    skeletons (see figure_skeleton and fill_figure), so only their traces are new.
+    Every trace is downsampled to at most budget points (see downsample_indices),
+    so the size of the figures doesn't grow with the range.
+    The last FIGURE_CACHE_SIZE figure pairs are kept, so a repeated range is not
+    sliced or built again. The figures are shared between calls and must not be mutated.
+    The region of data_sets is part of the key, as the data sets of a region dropped by
+    data_loading.region_data_sets may be reloaded into another dictionary.
     """
-    case_lower = data_sets['case data'][data_sets['case data']['Date'] > start_date]
-    df_case = case_lower[end_date > case_lower['Date']]
-    sent_lower = data_sets['sentiment data'][data_sets['sentiment data']['Date'] > start_date]
-    df_sentiment = sent_lower[end_date > sent_lower['Date']]
+    key = (id(data_sets), data_sets.get('region'), start_date, end_date, moving_av, historic,
+           downsample, budget)
+    with _figures_lock:
+        if key in _figures:
+            _figures.move_to_end(key)
+            metrics.METRICS.inc('dash_figure_cache_total', {'result': 'hit'})
+            return _figures[key]
 
-    graph_A = px.line(
-        data_frame=df_case,
-        x='Date',
-        y='New Cases',
-    )
+    metrics.METRICS.inc('dash_figure_cache_total', {'result': 'miss'})
+    figures = build_graph(data_sets, start_date, end_date, moving_av, historic, downsample, budget)
+    with _figures_lock:
+        _figures[key] = figures
+        while len(_figures) > FIGURE_CACHE_SIZE:
+            _figures.popitem(last=False)
+    return figures
+
+
+def date_slice(data: pd.DataFrame, start_date: datetime.datetime,
+               end_date: datetime.datetime) -> pd.DataFrame:
+    """Returns the rows of data with start_date < Date < end_date, found by binary search.
+    The rows are a slice of data, nothing is copied.
+
+    Preconditions:
+        - data is sorted by Date (see data_loading.sort_by_date)
+    """
+    return data.iloc[slice(*date_rows(data, start_date, end_date))]
+
+
+def date_rows(data: pd.DataFrame, start_date: datetime.datetime,
+              end_date: datetime.datetime) -> tuple[int, int]:
+    """Returns the row range [lo, hi) of date_slice
+
+    Preconditions:
+        - data is sorted by Date (see data_loading.sort_by_date)
+    """
+    dates = data['Date']
+    lo = dates.searchsorted(start_date, side='right')
+    return lo, max(lo, dates.searchsorted(end_date, side='left'))
+
+
+def build_graph(data_sets: dict[str, pd.DataFrame], start_date: datetime.datetime,
+                end_date: datetime.datetime, moving_av: bool, historic: bool,
+                downsample: Optional[str] = DOWNSAMPLE,
+                budget: int = POINT_BUDGET) -> tuple[dict, dict]:
+    """generate_graph without the figure cache, its slicing and figure construction are timed"""
+    with metrics.timer('generate_graph', 'slice'):
+        df_case = date_slice(data_sets['case data'], start_date, end_date)
+        df_sentiment = date_slice(data_sets['sentiment data'], start_date, end_date)
+
+    with metrics.timer('generate_graph', 'figure'):
+        return _build_figures(df_case, df_sentiment, moving_av, historic, downsample, budget)
+
+
+def downsample_indices(x: np.ndarray, y: np.ndarray, mode: Optional[str],
+                       budget: int) -> np.ndarray:
+    """Returns the sorted indices of at most budget points of the line x, y to plot.
+    The modes are
+        - 'lttb': Largest-Triangle-Three-Buckets, keeps the first and last point and from
+          each of budget - 2 buckets the point forming the largest triangle with the point
+          kept before it and the average of the next bucket, which keeps the visual shape
+        - 'minmax': keeps the lowest and highest point of each of budget // 2 buckets,
+          so no peak is ever lost
+        - None: keeps every point
+    Lines of at most budget points are kept whole.
+
+    Preconditions:
+        - mode in {'lttb', 'minmax', None}
+        - budget >= 3
+        - x is sorted
+    """
+    n = len(y)
+    if mode is None or n <= budget:
+        return np.arange(n)
+    if mode == 'minmax':
+        edges = np.linspace(0, n, budget // 2 + 1).astype(int)
+        kept = [[lo + np.argmin(y[lo:hi]), lo + np.argmax(y[lo:hi])]
+                for lo, hi in zip(edges[:-1], edges[1:])]
+        return np.unique(kept)
+
+    edges = np.linspace(1, n - 1, budget - 1).astype(int)
+    kept = np.empty(budget, dtype=int)
+    kept[0], kept[-1] = 0, n - 1
+    for i in range(budget - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        a = kept[i]
+        areas = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        kept[i + 1] = lo + np.argmax(areas)
+    return kept
+
+
+def _downsampled(data: pd.DataFrame, column: str, mode: Optional[str],
+                 budget: int) -> pd.DataFrame:
+    """the rows of data kept by downsample_indices for the line of column over Date"""
+    if mode is None or len(data) <= budget:
+        return data
+    x = data['Date'].values.astype('datetime64[ns]').astype(np.int64).astype(float)
+    return data.iloc[downsample_indices(x, data[column].values.astype(float), mode, budget)]
+
+
+def rolling_stat(daily: pd.DataFrame, column: str, window: int, stat: str,
+                 lo: int, hi: int) -> np.ndarray:
+    """Returns the rolling mean or standard deviation (stat) of column over the window days
+    ending at each of the rows lo to hi of daily, from its prefix sums in O(1) per day.
+    Windows reaching past the first day of daily are nan.
+
+    Preconditions:
+        - daily was made by data_loading.daily_series
+        - stat in {'mean', 'std'}
+        - window >= 1
+    """
+    ends = np.arange(lo, hi)
+    starts = ends - window
+    sums = _range_sums(daily[f'{column} Sum'].values, starts, ends)
+    mean = np.where(starts >= -1, sums / window, np.nan)
+    if stat == 'mean':
+        return mean
+    squares = _range_sums(daily[f'{column} Sum Sq'].values, starts, ends)
+    # sample variance like pandas' rolling std, a single day has none
+    variance = (squares - window * mean ** 2) / (window - 1) if window > 1 else mean * np.nan
+    return np.sqrt(np.maximum(variance, 0))
+
+
+def lag_correlation(daily: pd.DataFrame, lag_sums: pd.DataFrame, lo: int, hi: int,
+                    max_lag: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the lags from -max_lag to max_lag and the correlation, within rows lo to hi
+    of daily, between new cases and sentiment that many days later.
+    Each lag only pairs days that are both in the range, from the prefix sums in O(1).
+    Lags leaving fewer than 3 pairs are nan.
+
+    Preconditions:
+        - daily and lag_sums were made by data_loading.daily_series and data_loading.lag_sums
+        - 0 <= max_lag <= the largest lag in lag_sums
+    """
+    lags = np.arange(-max_lag, max_lag + 1)
+    # the days t paired with t + lag
+    first, last = np.maximum(lo, lo - lags), np.minimum(hi, hi - lags) - 1
+    valid = last - first >= 2
+    first, last = np.where(valid, first, 0), np.where(valid, last, 0)
+    n = (last - first + 1).astype(float)
+    sum_x = _range_sums(daily['New Cases Sum'].values, first - 1, last)
+    sum_xx = _range_sums(daily['New Cases Sum Sq'].values, first - 1, last)
+    y_before, y_last = np.where(valid, first - 1 + lags, -1), np.where(valid, last + lags, 0)
+    sum_y = _range_sums(daily['Sentiment Sum'].values, y_before, y_last)
+    sum_yy = _range_sums(daily['Sentiment Sum Sq'].values, y_before, y_last)
+    products = lag_sums[[f'Lag {lag}' for lag in lags]].values
+    sum_xy = _range_sums(products, first - 1, last, np.arange(len(lags)))
+
+    covariance = n * sum_xy - sum_x * sum_y
+    spread = np.sqrt(np.maximum(n * sum_xx - sum_x ** 2, 0) * np.maximum(n * sum_yy - sum_y ** 2, 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return lags, np.where(valid & (spread > 0), covariance / spread, np.nan)
+
+
+def _range_sums(prefix: np.ndarray, before: np.ndarray, last: np.ndarray,
+                columns: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    sums of the days after row before up to and including row last from the cumulative
+    sums prefix, row -1 (or before it) counts as 0, columns picks a column of a 2d prefix
+    for each range
+    """
+    before_clipped = np.clip(before, 0, len(prefix) - 1)
+    if columns is None:
+        return prefix[last] - np.where(before >= 0, prefix[before_clipped], 0)
+    return prefix[last, columns] - np.where(before >= 0, prefix[before_clipped, columns], 0)
+
+
+def build_rolling_graph(data_sets: dict[str, pd.DataFrame], start_date: datetime.datetime,
+                        end_date: datetime.datetime, window: int, stat: str) -> go.Figure:
+    """Returns the rolling mean or standard deviation (stat) over window days of new cases
+    and, on a second axis, of sentiment, for the days between start_date and end_date.
+    """
+    daily = data_sets['daily data']
+    with metrics.timer('build_rolling_graph', 'stats'):
+        lo, hi = date_rows(daily, start_date, end_date)
+        cases = rolling_stat(daily, 'New Cases', window, stat, lo, hi)
+        sentiment = rolling_stat(daily, 'Sentiment', window, stat, lo, hi)
+
+    with metrics.timer('build_rolling_graph', 'figure'):
+        dates = daily['Date'].values[lo:hi]
+        label = 'Mean' if stat == 'mean' else 'Std'
+        figure = make_subplots(specs=[[{'secondary_y': True}]])
+        figure.add_trace(go.Scatter(x=dates, y=cases, mode='lines',
+                                    name=f'New Cases {window}-Day {label}'), secondary_y=False)
+        figure.add_trace(go.Scatter(x=dates, y=sentiment, mode='lines',
+                                    name=f'Sentiment {window}-Day {label}'), secondary_y=True)
+        figure.update_xaxes(title_text='Date')
+        figure.update_yaxes(title_text=f'New Cases {label}', secondary_y=False)
+        figure.update_yaxes(title_text=f'Sentiment {label}', secondary_y=True)
+        return figure
+
+
+def build_lag_graph(data_sets: dict[str, pd.DataFrame], start_date: datetime.datetime,
+                    end_date: datetime.datetime, max_lag: int) -> go.Figure:
+    """Returns the correlation between new cases and sentiment lag days later, for every
+    lag from -max_lag to max_lag, over the days between start_date and end_date.
+    """
+    daily = data_sets['daily data']
+    with metrics.timer('build_lag_graph', 'stats'):
+        lags, correlation = lag_correlation(daily, data_sets['lag sums'],
+                                            *date_rows(daily, start_date, end_date), max_lag)
+
+    with metrics.timer('build_lag_graph', 'figure'):
+        figure = go.Figure(go.Bar(x=lags, y=correlation))
+        figure.update_xaxes(title_text='Days Sentiment Lags New Cases')
+        figure.update_yaxes(title_text='Correlation', range=[-1, 1])
+        return figure
+
+
+def series_store(data_sets: dict[str, pd.DataFrame]) -> dict:
+    """Returns the whole case and sentiment series, with the skeletons of their figures
+    (see figure_skeleton), as the compact json kept in the browser for the clientside
+    version of generate_graph (assets/graphs.js), which slices the series by date,
+    downsamples every trace like generate_graph and shows or hides the moving average
+    and historic traces.
+
+    Dates are 'YYYY-MM-DD' strings so they compare in order as text.
+    """
+    return {
+        'case': _series(data_sets['case data'], [column for column, _ in CASE_TRACES]),
+        'sentiment': _series(data_sets['sentiment data'],
+                             [column for column, _ in SENTIMENT_TRACES]),
+        'case figure': figure_skeleton('New Cases', CASE_TRACES),
+        'sentiment figure': figure_skeleton('Sentiment', SENTIMENT_TRACES),
+        'downsample': DOWNSAMPLE,
+        'point budget': POINT_BUDGET,
+        'webgl points': WEBGL_POINTS,
+    }
+
+
+def _series(data: pd.DataFrame, columns: list[str]) -> dict[str, list]:
+    """the Date column as text and columns of data as lists"""
+    series = {'Date': data['Date'].dt.strftime('%Y-%m-%d').tolist()}
+    series.update({column: data[column].tolist() for column in columns})
+    return series
+
+
+@functools.lru_cache(maxsize=None)
+def figure_skeleton(y_title: str, traces: tuple) -> dict:
+    """
+    Returns the layout, with the default template resolved, and the traces without
+    their x and y of a line figure over Date, built once for every (y_title, traces).
+    traces holds the column each trace plots and the toggle that shows it
+    (None for always shown), the first trace is the main line.
+    The skeleton is shared and must not be mutated.
+    """
+    layout = go.Layout(template=pio.templates[pio.templates.default],
+                       xaxis={'title': {'text': 'Date'}},
+                       yaxis={'title': {'text': y_title}},
+                       legend={'tracegroupgap': 0}, margin={'t': 60}).to_plotly_json()
+    skeleton_traces = []
+    for i, (column, toggle) in enumerate(traces):
+        trace = {'type': 'scatter', 'mode': 'lines', 'name': column,
+                 'hovertemplate': f'Date=%{{x}}<br>{column}=%{{y}}<extra></extra>'}
+        if i == 0:
+            trace['showlegend'] = False
+        skeleton_traces.append({'trace': trace, 'column': column, 'toggle': toggle})
+    return {'layout': layout, 'traces': skeleton_traces}
+
+
+def fill_figure(skeleton: dict, data: pd.DataFrame, toggles: dict[str, bool],
+                downsample: Optional[str] = None, budget: int = POINT_BUDGET) -> dict:
+    """
+    Returns the figure of skeleton (see figure_skeleton) plotting the columns of data,
+    with only the traces that are always shown or whose toggle is on.
+    Only the x and y of each trace are new, the layout is the skeleton's.
+    Traces over more than WEBGL_POINTS rows of data are drawn with WebGL (Scattergl),
+    whether or not they are downsampled, so the renderer only depends on the range.
+    """
+    traces = []
+    for entry in skeleton['traces']:
+        if entry['toggle'] is not None and not toggles.get(entry['toggle']):
+            continue
+        rows = _downsampled(data, entry['column'], downsample, budget)
+        trace = {**entry['trace'], 'x': rows['Date'].values, 'y': rows[entry['column']].values}
+        if len(data) > WEBGL_POINTS:
+            trace['type'] = 'scattergl'
+        traces.append(trace)
+    return {'data': traces, 'layout': skeleton['layout']}
+
+
+def partial_figure(figure: dict) -> Any:
+    """
+    Returns a Patch replacing only the traces of a graph that already shows a figure
+    with the same layout, so the layout and its template are not sent again.
+    The axes are autoranged to the new traces like a whole new figure would be.
+    Without dash.Patch (dash before 2.9) the whole figure is returned.
+    """
+    if Patch is None:
+        return figure
+    patch = Patch()
+    patch['data'] = figure['data']
+    patch['layout']['xaxis']['autorange'] = True
+    patch['layout']['yaxis']['autorange'] = True
+    return patch
 
-    if moving_av:
-        graph_A.add_trace(
-            go.Line(
-                x=df_case.loc[:, 'Date'],
-                y=df_case.loc[:, '7-Day Moving Avg']
-            )
-        )
-    
-    if historic:
-        graph_A.add_trace(
-            go.Line(
-                x=df_case.loc[:, 'Date'],
-                y=df_case.loc[:, 'Historic Cases']
-            )
-        )
-
-    graph_B = px.line(
-        data_frame=df_sentiment,
-        x='Date',
-        y='Sentiment',
-    )
 
-    return graph_A, graph_B
\ No newline at end of file
+def _build_figures(df_case: pd.DataFrame, df_sentiment: pd.DataFrame,
+                   moving_av: bool, historic: bool, downsample: Optional[str] = None,
+                   budget: int = POINT_BUDGET) -> tuple[dict, dict]:
+    """builds the case and sentiment figures of the sliced data, downsampling every trace"""
+    toggles = {'moving_av': moving_av, 'historic': historic}
+    return (fill_figure(figure_skeleton('New Cases', CASE_TRACES), df_case, toggles,
+                        downsample, budget),
+            fill_figure(figure_skeleton('Sentiment', SENTIMENT_TRACES), df_sentiment, toggles,
+                        downsample, budget))
@@ -0,0 +1,164 @@
+"""Latency instrumentation for the Dash app, exposed in the Prometheus text format
+
+Callbacks are timed as a whole with instrument and in phases with timer. Every
+request to a Dash callback is also timed end to end on the Flask server, which
+includes the JSON serialization of the figures, and its response size recorded.
+install adds all of it to a Flask server together with the /metrics route.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+import flask
+
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (1_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)
+METRICS_ROUTE = '/metrics'
+# requests for callbacks go to this route of the dash server
+CALLBACK_ROUTE = '_dash-update-component'
+
+
+class Metrics:
+    """
+    Thread safe counters and histograms rendered in the Prometheus text format
+
+    Instance Attributes:
+        - help: description of each metric name
+    """
+    help: dict[str, str]
+
+    def __init__(self) -> None:
+        self.help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, labels: dict[str, str], amount: float = 1) -> None:
+        """adds amount to the counter name with labels"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, labels: dict[str, str], value: float,
+                buckets: tuple = SECONDS_BUCKETS) -> None:
+        """records value in the histogram name with labels"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._buckets.setdefault(name, buckets)
+            counts = self._histograms.setdefault(key, [0] * (len(buckets) + 1) + [0.0])
+            for i, bound in enumerate(self._buckets[name]):
+                if value <= bound:
+                    counts[i] += 1
+            # the +Inf bucket, then the sum
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self) -> str:
+        """returns every metric in the Prometheus text exposition format"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(counts)) for key, counts in self._histograms.items())
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.extend(self._header(name, 'counter'))
+            lines.append(f'{name}{_labels(labels)} {value}')
+        for (name, labels), counts in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.extend(self._header(name, 'histogram'))
+            for bound, count in zip(self._buckets[name], counts):
+                lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {count}')
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {counts[-2]}')
+            lines.append(f'{name}_sum{_labels(labels)} {counts[-1]}')
+            lines.append(f'{name}_count{_labels(labels)} {counts[-2]}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self) -> None:
+        """drops every recorded value"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def _header(self, name: str, kind: str) -> list[str]:
+        """the HELP and TYPE lines of name"""
+        return [f'# HELP {name} {self.help.get(name, name)}', f'# TYPE {name} {kind}']
+
+
+def _labels(labels: tuple) -> str:
+    """formats label pairs as {a="1",b="2"}"""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+# metrics of this process
+METRICS = Metrics()
+METRICS.help.update({
+    'dash_callback_seconds': 'Time spent inside each callback function',
+    'dash_callback_errors_total': 'Callbacks that raised an exception',
+    'dash_phase_seconds': 'Time spent in each phase of a callback',
+    'dash_request_seconds': 'Time to answer each callback request, including serialization',
+    'dash_response_bytes': 'Size of each callback response',
+    'dash_requests_total': 'Callback requests by status code',
+    'dash_figure_cache_total': 'Figure cache lookups of graph_updater.generate_graph',
+})
+
+
+def instrument(callback: str) -> Callable:
+    """decorator timing every call of a callback function as callback"""
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                METRICS.inc('dash_callback_errors_total', {'callback': callback})
+                raise
+            finally:
+                METRICS.observe('dash_callback_seconds', {'callback': callback},
+                                time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timer(callback: str, phase: str) -> Iterator[None]:
+    """times the body of a with statement as phase of callback"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.observe('dash_phase_seconds', {'callback': callback, 'phase': phase},
+                        time.perf_counter() - start)
+
+
+def install(server: flask.Flask) -> None:
+    """times the callback requests of server and serves METRICS at METRICS_ROUTE"""
+    @server.before_request
+    def start_timer() -> None:
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response: flask.Response) -> flask.Response:
+        if flask.request.path.endswith(CALLBACK_ROUTE) and 'metrics_start' in flask.g:
+            body = flask.request.get_json(silent=True) or {}
+            labels = {'callback': str(body.get('output', 'unknown'))}
+            METRICS.observe('dash_request_seconds', labels,
+                            time.perf_counter() - flask.g.metrics_start)
+            if not response.direct_passthrough:
+                METRICS.observe('dash_response_bytes', labels, len(response.get_data()),
+                                BYTES_BUCKETS)
+            METRICS.inc('dash_requests_total', {**labels, 'status': str(response.status_code)})
+        return response
+
+    @server.route(METRICS_ROUTE)
+    def metrics() -> flask.Response:
+        return flask.Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,186 @@
+"""Region partitioned storage for the case data
+
+covid_cases.csv holds the cases of every region (its State column) in one file.
+write_partitions splits it into one columnar table per region (see util.columnar)
+in a new generation directory and writes an index from each region to its partition:
+
+    data/columnar/cases/regions.json                          region -> partition, rows, dates
+    data/columnar/cases/<generation>/united-states-<sha1>/    Date, New Cases,
+    ...                                                       7-Day Moving Avg, Historic Cases
+
+The index is replaced in one rename once its generation is written, so a reader
+always finds a complete generation. The previous generation is kept for readers
+holding the old index, and rebuilds by several processes take turns on a lock file.
+
+A CaseStore only reads the index when it is made, and again when its generation
+has been removed by later rebuilds. Partitions are read the first time
+their region is asked for and at most capacity regions are kept in memory, the
+least recently used one is dropped first, so neither the startup time nor the memory
+of the app grows with the number of regions.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+import pandas as pd
+from util import columnar
+try:
+    import fcntl
+except ImportError:
+    # windows has no fcntl, rebuilds aren't locked there
+    fcntl = None
+
+CASES_TABLE = os.path.join(columnar.COLUMNAR_PATH, 'cases')
+INDEX_FILE = 'regions.json'
+# the region shown when none is selected, it is always kept in memory by get_data
+DEFAULT_REGION = 'United States'
+# regions kept in memory by a CaseStore
+RESIDENT_REGIONS = 16
+
+
+def write_partitions(data: pd.DataFrame, path: str = CASES_TABLE) -> dict[str, dict]:
+    """
+    Writes the rows of each region of the case data, without the State column, to a
+    partition of its own in a new generation directory of path and returns the index
+    from region to partition.
+    The index is written last and replaces the old one with a single rename, so readers
+    see either every old or every new partition and path is never missing. Generations
+    older than the one the replaced index pointed to are removed, and the whole rebuild
+    holds an exclusive lock on path.lock so concurrent rebuilds don't interleave.
+
+    Precondition:
+        - 'State' in data.columns and 'Date' in data.columns
+        - the Date column is cleaned (see data_loading.clean_case_data)
+    """
+    os.makedirs(path, exist_ok=True)
+    with _rebuild_lock(path):
+        generation = f'{time.time_ns():020d}-{os.getpid()}'
+        index = {}
+        for region, rows in data.groupby('State', sort=True):
+            partition = os.path.join(generation, partition_name(region))
+            columnar.write_table(rows.drop(columns='State'), os.path.join(path, partition))
+            index[region] = {'partition': partition, 'rows': len(rows),
+                             'start': rows['Date'].min().strftime('%Y-%m-%d'),
+                             'end': rows['Date'].max().strftime('%Y-%m-%d')}
+
+        keep = {generation}
+        if partitions_exist(path):
+            keep.update(os.path.dirname(entry['partition']) for entry in read_index(path).values())
+        temporary = os.path.join(path, f'{INDEX_FILE}.tmp-{os.getpid()}')
+        with open(temporary, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary, os.path.join(path, INDEX_FILE))
+
+        for name in os.listdir(path):
+            if name not in keep and os.path.isdir(os.path.join(path, name)):
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return index
+
+
+@contextlib.contextmanager
+def _rebuild_lock(path: str):
+    """holds an exclusive lock on path.lock while the partitions of path are written"""
+    with open(f'{path}.lock', 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def read_index(path: str = CASES_TABLE) -> dict[str, dict]:
+    """reads the index written by write_partitions"""
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def partition_name(region: str) -> str:
+    """
+    the directory of the partition of region, the same for every write:
+    a readable slug of the name and a hash prefix so different names never collide
+    """
+    slug = re.sub(r'[^a-z0-9]+', '-', region.lower()).strip('-')
+    return f'{slug}-{hashlib.sha1(region.encode("utf-8")).hexdigest()[:12]}'
+
+
+def partitions_exist(path: str = CASES_TABLE) -> bool:
+    """returns whether path holds partitions written by write_partitions"""
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+class CaseStore:
+    """
+    Lazily loaded case data of every region, with an LRU of the regions in memory
+
+    Instance Attributes:
+        - path: the directory written by write_partitions
+        - capacity: the most regions kept in memory
+        - index: the partition, row count and date range of each region
+        - loads: number of partitions read from disk
+
+    Representation Invariants:
+        - self.capacity >= 1
+    """
+    path: str
+    capacity: int
+    index: dict[str, dict]
+    loads: int
+
+    def __init__(self, path: str = CASES_TABLE, capacity: int = RESIDENT_REGIONS,
+                 derive: Optional[Callable[[str, pd.DataFrame], Any]] = None) -> None:
+        """
+        derive(region, case data) turns the case data of a region into what get returns
+        and keeps in memory
+        """
+        self.path = path
+        self.capacity = capacity
+        self.index = read_index(path)
+        self.loads = 0
+        self._derive = derive
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+
+    def regions(self) -> list[str]:
+        """the names of every region, sorted"""
+        return sorted(self.index)
+
+    def resident(self) -> list[str]:
+        """the regions in memory, least recently used first"""
+        with self._lock:
+            return list(self._resident)
+
+    def get(self, region: str) -> Any:
+        """
+        returns the case data of region sorted by date, without the State column,
+        passed through derive when given,
+        reading its partition when the region isn't in memory
+
+        Raises KeyError when there is no such region
+        """
+        with self._lock:
+            if region in self._resident:
+                self._resident.move_to_end(region)
+                return self._resident[region]
+        if region not in self.index:
+            raise KeyError(region)
+
+        try:
+            data = columnar.read_table(os.path.join(self.path, self.index[region]['partition']))
+        except FileNotFoundError:
+            # the partitions were written again twice since the index was read
+            self.index = read_index(self.path)
+            if region not in self.index:
+                raise KeyError(region) from None
+            data = columnar.read_table(os.path.join(self.path, self.index[region]['partition']))
+        if self._derive is not None:
+            data = self._derive(region, data)
+        with self._lock:
+            self.loads += 1
+            self._resident[region] = data
+            while len(self._resident) > self.capacity:
+                self._resident.popitem(last=False)
+        return data
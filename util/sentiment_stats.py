@@ -0,0 +1,121 @@
+"""Mergeable per-day sentiment statistics
+
+Every day keeps a count, sum, sum of squares and a fixed-bin histogram of the
+sentiments, so partial results from shards or workers combine by addition in
+O(days) and the mean, standard deviation, median and confidence bands can be
+published without rescanning the raw predictions.
+"""
+import numpy as np
+import pandas as pd
+
+# sentiments lie in [-1, 1], so 200 bins bound quantile errors to 0.01
+N_BINS = 200
+# z value of the two-sided 95% confidence band of the daily mean
+Z_95 = 1.959964
+_COUNT, _SUM, _SUMSQ, _HIST = 0, 1, 2, 3
+
+
+class DailyStats:
+    """
+    Per-day aggregates of sentiment values that can be updated and merged
+
+    Instance Attributes:
+        - days: maps each date to [count, sum, sum of squares, *histogram]
+    """
+    days: dict[pd.Timestamp, np.ndarray]
+
+    def __init__(self) -> None:
+        self.days = {}
+
+    def add(self, dates: pd.Series, sentiments: list[float]) -> None:
+        """
+        folds sentiments into the days given by the matching entries of dates
+
+        Precondition:
+            - len(dates) == len(sentiments)
+            - all(-1 <= s <= 1 for s in sentiments)
+        """
+        values = np.asarray(sentiments, dtype=float)
+        day_codes, uniques = pd.factorize(pd.Series(dates).values)
+        n_days = len(uniques)
+        counts = np.bincount(day_codes, minlength=n_days)
+        sums = np.bincount(day_codes, weights=values, minlength=n_days)
+        sumsqs = np.bincount(day_codes, weights=values * values, minlength=n_days)
+        bins = np.clip(((values + 1) * N_BINS / 2).astype(int), 0, N_BINS - 1)
+        hists = np.bincount(day_codes * N_BINS + bins,
+                            minlength=n_days * N_BINS).reshape(n_days, N_BINS)
+
+        for i, date in enumerate(uniques):
+            day = self._day(pd.Timestamp(date))
+            day[_COUNT] += counts[i]
+            day[_SUM] += sums[i]
+            day[_SUMSQ] += sumsqs[i]
+            day[_HIST:] += hists[i]
+
+    def merge(self, other: 'DailyStats') -> 'DailyStats':
+        """adds the aggregates of other into self and returns self"""
+        for date, state in other.days.items():
+            self._day(date)[:] += state
+        return self
+
+    def count(self) -> int:
+        """returns the number of sentiments folded in over all days"""
+        return int(sum(state[_COUNT] for state in self.days.values()))
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        returns one row per day, sorted by date, with the columns
+        Date, Sentiment (the mean), Count, Std, Median, CI Lower and CI Upper
+        """
+        dates = sorted(self.days)
+        states = np.array([self.days[date] for date in dates]).reshape(len(dates), _HIST + N_BINS)
+        counts, sums, sumsqs = states[:, _COUNT], states[:, _SUM], states[:, _SUMSQ]
+        means = sums / counts
+        variances = np.maximum(sumsqs / counts - means ** 2, 0) * counts / np.maximum(counts - 1, 1)
+        stds = np.sqrt(variances)
+        margin = Z_95 * stds / np.sqrt(counts)
+        return pd.DataFrame({
+            'Date': dates,
+            'Sentiment': means,
+            'Count': counts.astype(int),
+            'Std': stds,
+            'Median': _quantiles(states[:, _HIST:], 0.5),
+            'CI Lower': means - margin,
+            'CI Upper': means + margin,
+        })
+
+    def save(self, path: str) -> None:
+        """writes the aggregates to an .npz file so they can be merged later"""
+        dates = sorted(self.days)
+        np.savez(path, dates=np.array(dates, dtype='datetime64[ns]'),
+                 states=np.array([self.days[date] for date in dates]))
+
+    @classmethod
+    def load(cls, path: str) -> 'DailyStats':
+        """reads aggregates written by save"""
+        stats = cls()
+        with np.load(path) as f:
+            for date, state in zip(f['dates'], f['states']):
+                stats.days[pd.Timestamp(date)] = state.copy()
+        return stats
+
+    def _day(self, date: pd.Timestamp) -> np.ndarray:
+        """returns the state of date, creating an empty one if needed"""
+        if date not in self.days:
+            self.days[date] = np.zeros(_HIST + N_BINS)
+        return self.days[date]
+
+
+def _quantiles(hists: np.ndarray, q: float) -> np.ndarray:
+    """
+    estimates the q-th quantile of each histogram row,
+    interpolating linearly within the bin that crosses q
+    """
+    cumulative = np.cumsum(hists, axis=1)
+    target = q * cumulative[:, -1:]
+    bins = np.minimum((cumulative < target).sum(axis=1), N_BINS - 1)
+    rows = np.arange(len(hists))
+    before = np.where(bins > 0, cumulative[rows, np.maximum(bins - 1, 0)], 0)
+    in_bin = np.maximum(hists[rows, bins], 1)
+    fraction = (target[:, 0] - before) / in_bin
+    return -1 + (bins + fraction) * 2 / N_BINS
@@ -0,0 +1,18 @@
+"""Helpers for the sqlite files of the sentiment cache and the dedupe index"""
+import sqlite3
+from typing import Iterator
+
+# sqlite limits the number of host parameters in a single statement
+QUERY_CHUNK = 500
+
+
+def select_in(conn: sqlite3.Connection, query: str, keys: list,
+              params: tuple = ()) -> Iterator[tuple]:
+    """
+    Runs query over keys QUERY_CHUNK keys at a time and yields every row it returns.
+    The {} in query stands for the placeholders of an IN list of keys,
+    params are bound before the keys.
+    """
+    for i in range(0, len(keys), QUERY_CHUNK):
+        chunk = keys[i:i + QUERY_CHUNK]
+        yield from conn.execute(query.format(','.join('?' * len(chunk))), [*params, *chunk])
@@ -0,0 +1,16 @@
+"""Entry point for pre-fork WSGI servers, e.g.
+
+    gunicorn --preload --workers 4 --bind 0.0.0.0:8050 wsgi:server
+
+With --preload the app and its data sets are built once in the master process and
+the forked workers share them copy-on-write instead of each loading its own copy.
+"""
+import gc
+import app
+
+application = app.create_app()
+server = application.server
+
+# objects made before the fork are never collected, so the collector
+# doesn't write to the shared pages holding them from every worker
+gc.freeze()